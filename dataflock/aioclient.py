@@ -0,0 +1,135 @@
+import asyncio
+import json
+
+import aiohttp
+
+
+class AsyncClient(object):
+    """
+    The asyncio version of client.Client. All the requests go through one pool of kept alive
+    connections, so many environments can be driven at once from a single event loop.
+    """
+
+    def __init__(self, server="http://localhost:8080/", connector=None, limit=100):
+        self._server = server
+        # a connector can be shared between clients, it's then closed by its owner
+        self._connector = connector
+        self._limit = limit
+        self._session = None
+
+    @property
+    def session(self):
+        if self._session is None:
+            connector = self._connector or aiohttp.TCPConnector(limit=self._limit)
+            self._session = aiohttp.ClientSession(
+                connector=connector, connector_owner=self._connector is None)
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def _request(self, method, path, params=None, response=False, **kwargs):
+        if isinstance(params, dict):
+            params = [(k, v) for k, v in params.items() if v is not None]
+        async with self.session.request(method, self._server + path, params=params, **kwargs) as r:
+            r.raise_for_status()
+            if response:
+                return r, await r.text()
+            return await r.text()
+
+    async def list_environments(self):
+        return await self._request('GET', '')
+
+    async def create_environment(self, name, timeout=None, cpu_timeout=None):
+        return await self._request(
+            'POST', '', json={'name': name, 'timeout': timeout, 'cpu_timeout': cpu_timeout})
+
+    async def create_cell(self, environment, code, live=True):
+        return await self._request(
+            'POST', environment + '/cells', json={'code': code, 'live': live})
+
+    async def update_cell(self, environment, cell_id, code, live=True):
+        return await self._request(
+            'POST', environment + '/cells/' + cell_id, json={'code': code, 'live': live})
+
+    async def get(self, environment, name, start=None, stop=None):
+        return await self._request(
+            'GET', environment + '/variables/' + name, params={'start': start, 'stop': stop})
+
+    async def poll(self, environment, name, version=None, wait=None):
+        """
+        Get a variable only if it changed since version: returns (version, value), with None
+        as the value if it didn't. With wait, waits for a change up to wait seconds.
+        """
+        params = {}
+        headers = {}
+        if version is not None:
+            headers['If-None-Match'] = '"{}"'.format(version)
+            if wait is not None:
+                params = {'after': version, 'timeout': wait}
+        if wait is not None:
+            # the server answers a long poll at most after wait seconds
+            kwargs = dict(timeout=aiohttp.ClientTimeout(total=None, sock_read=None))
+        else:
+            kwargs = {}
+        r, text = await self._request('GET', environment + '/variables/' + name, params=params,
+                                      headers=headers, response=True, **kwargs)
+        version = int(r.headers['ETag'].strip('"'))
+        return version, (None if r.status == 304 else text)
+
+    async def get_many(self, environment, names):
+        return await self._request(
+            'GET', environment + '/variables', params=[('name', name) for name in names])
+
+    async def update_cells(self, environment, cells, live=True):
+        return await self._request(
+            'POST', environment + '/batch/cells', json={'cells': list(cells), 'live': live})
+
+    async def create_cells(self, environment, codes, live=True):
+        return await self.update_cells(environment, [{'code': code} for code in codes], live)
+
+    async def usage(self, environment):
+        return await self._request('GET', environment + '/usage')
+
+    async def interrupt(self, environment):
+        return await self._request('POST', environment + '/interrupt')
+
+    async def fan_out(self, method, environments, *args, **kwargs):
+        """
+        Call a method for many environments concurrently, eg.
+        fan_out('get', ['env1', 'env2'], 'a'). Returns an environment: result dict.
+        """
+        call = getattr(self, method)
+        results = await asyncio.gather(*[call(env, *args, **kwargs) for env in environments])
+        return dict(zip(environments, results))
+
+    async def events(self, environment, stream='events', replay=False):
+        """
+        Iterate over the events of an environment as they happen (stream='output' for what the
+        cells print), instead of polling for changes.
+        """
+        params = {'stream': stream}
+        if replay:
+            params['replay'] = '1'
+        # the stream stays open as long as the client wants it
+        timeout = aiohttp.ClientTimeout(total=None, sock_read=None)
+        async with self.session.get(self._server + environment + '/events',
+                                    params=params, timeout=timeout) as r:
+            r.raise_for_status()
+            data = []
+            async for line in r.content:
+                line = line.decode().rstrip('\r\n')
+                if not line:
+                    if data:
+                        yield json.loads('\n'.join(data))
+                        data = []
+                elif line.startswith('data:'):
+                    data.append(line[5:].lstrip(' '))
@@ -1,6 +1,14 @@
 import ast
+import asyncio
 import builtins
-from enum import Enum
+import concurrent.futures
+import hashlib
+import multiprocessing
+import os
+import pickle
+import sys
+from collections import OrderedDict
+from enum import IntEnum
 
 import attr
 
@@ -9,27 +17,365 @@ BUILTINS = set(dir(builtins))
 
 
 class Cell:
-    def __init__(self, code):
+    def __init__(self, code, cache=None, previous=None):
+        """
+        Analyze the code of a cell.
+        When the previous version of the cell is given, the analysis of its unchanged top-level
+        statements is reused.
+        """
         self.code = code
-        self.depends = find_missing_vars(code)
-        self.exposes = set()
+        self.statements = None
 
-        tree = ast.parse(code)
-        for n in ast.walk(tree):
-            if isinstance(n, ast.Assign):
-                for name in n.targets:
-                    self.exposes.add(name.id)
+        if previous is not None:
+            self.statements = analyze_statements(code, previous.statements)
+            result = combine_statements(self.statements)
+        elif cache is not None:
+            result = cache.get(code)
+        else:
+            result = analyze(code)
+        self.depends = result.depends
+        self.exposes = result.exposes
 
     def __eq__(self, other):
         return other.code == self.code
 
+    def same_interface(self, other):
+        """
+        True if both cells depend on and expose the same variables.
+        """
+        return self.depends == other.depends and self.exposes == other.exposes
+
+
+class AnalysisPool:
+    """
+    The pool of processes analyzing cells, started on first use and kept for the next ones.
+    Its processes are started by a fork server, instead of being forked from this process (and
+    its threads).
+    """
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers
+        self._executor = None
+
+    def executor(self, max_workers=None):
+        """The executor, restarted if it doesn't have the number of workers asked for."""
+        if max_workers is not None and max_workers != self.max_workers:
+            self.close()
+            self.max_workers = max_workers
+        if self._executor is None:
+            self._executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context("forkserver"))
+        return self._executor
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+def _analyze_codes(codes):
+    return [Cell(code) for code in codes]
+
+
+def analyze_cells(codes, max_workers=None, chunksize=32):
+    """
+    Analyze the code of many cells in parallel, in the process pool.
+    With max_workers=1 the cells are analyzed in this process.
+    """
+    if max_workers == 1:
+        return _analyze_codes(codes)
+
+    return list(pool.executor(max_workers).map(Cell, codes, chunksize=chunksize))
+
+
+async def analyze_cells_async(codes, max_workers=None, chunksize=32, cache=None):
+    """
+    Analyze the code of many cells in the process pool, without blocking the event loop.
+    With a cache, only the code that isn't cached already is analyzed (and then cached).
+    """
+    cells = [None] * len(codes)
+    missing = []
+    for i, code in enumerate(codes):
+        if cache is not None and code in cache:
+            cells[i] = Cell(code, cache=cache)
+        else:
+            missing.append(i)
+    if not missing:
+        return cells
+
+    loop = asyncio.get_event_loop()
+    executor = pool.executor(max_workers)
+    chunks = [missing[start:start + chunksize] for start in range(0, len(missing), chunksize)]
+    results = await asyncio.gather(*[
+        loop.run_in_executor(executor, _analyze_codes, [codes[i] for i in chunk])
+        for chunk in chunks])
+    for chunk, analyzed in zip(chunks, results):
+        for i, cell in zip(chunk, analyzed):
+            cells[i] = cell
+            if cache is not None:
+                cache.add(cell.code, cell.depends, cell.exposes)
+    return cells
+
+
+@attr.s
+class Analysis:
+    """
+    The result of analyzing a piece of code: its depends, exposes and scope tree.
+    """
+    depends = attr.ib()
+    exposes = attr.ib()
+    scope_root = attr.ib()
+
+
+def analyze(code, keep_ast=True):
+    """
+    Analyze code in a single pass: the code is parsed once, and the same AST is used to build
+    the scope tree, find the exposed variables and find the missing (depended upon) variables.
+    With keep_ast=False the scope tree doesn't keep the AST alive.
+    """
+    ast_root = ast.parse(code)
+    exposes = set()
+    scope_root = ScopeTreeNode.build_from_ast_node(ast_root, exposes=exposes)
+    if not keep_ast:
+        scope_root.drop_ast()
+
+    return Analysis(
+        depends=find_missing_vars(scope_root),
+        exposes=exposes,
+        scope_root=scope_root,
+    )
+
+
+@attr.s(slots=True)
+class StatementAnalysis:
+    """
+    The analysis of a single top-level statement, to be combined with the other statements of
+    the cell.
+    """
+    # name set by the statement itself when it's a function or class definition
+    header = attr.ib()
+    # the rest of the variable uses in the global scope, in order
+    variable_uses = attr.ib()
+    # names read in nested scopes and not defined in them, to be resolved in the global scope
+    free_vars = attr.ib()
+    # names set in the global scope
+    sets_vars = attr.ib()
+    exposes = attr.ib()
+
+
+# statements that make the following code optional (see ScopeTreeNode.build_from_ast_node)
+OPTIONAL_STATEMENTS = (ast.If, ast.While, ast.For, ast.Try)
+
+
+def analyze_statements(code, previous=None):
+    """
+    Analyze each top-level statement of the code on its own.
+    Returns a list of (key, StatementAnalysis), where the key identifies the statement source
+    and context. Statements with a key already in the previous analysis are not analyzed again.
+    """
+    reusable = dict(previous or ())
+    ast_root = ast.parse(code)
+
+    # statement positions are in bytes
+    source = code.encode('utf-8')
+    line_starts = [0]
+    for line in source.splitlines(keepends=True):
+        line_starts.append(line_starts[-1] + len(line))
+
+    statements = []
+    is_optional = False
+    for statement in ast_root.body:
+        first = min([statement] + getattr(statement, 'decorator_list', []),
+                    key=lambda node: (node.lineno, node.col_offset))
+        start = line_starts[first.lineno - 1] + first.col_offset
+        end = line_starts[statement.end_lineno - 1] + statement.end_col_offset
+
+        key = (source[start:end], is_optional)
+        try:
+            statement_analysis = reusable[key]
+        except KeyError:
+            statement_analysis = analyze_statement(statement, is_optional)
+        statements.append((key, statement_analysis))
+
+        if isinstance(statement, OPTIONAL_STATEMENTS):
+            is_optional = True
+
+    return statements
+
+
+def analyze_statement(statement, is_optional):
+    """
+    Analyze a single top-level statement.
+    """
+    exposes = set()
+    scope_root = ScopeTreeNode.build_from_ast_node(
+        ast.Module(body=[statement], type_ignores=[]), is_optional=is_optional, exposes=exposes)
+
+    variable_uses = scope_root.variable_uses
+    header = None
+    if isinstance(statement, (ast.FunctionDef, ast.ClassDef)):
+        header = variable_uses[0].name
+        variable_uses = variable_uses[1:]
+
+    free_vars = set()
+    pending = list(scope_root.children)
+    while pending:
+        scope = pending.pop()
+        for name in unresolved_reads(scope.variable_uses):
+            if not scope.variable_in_parent_scopes(name, until=scope_root):
+                free_vars.add(name)
+        pending.extend(scope.children)
+
+    return StatementAnalysis(
+        header=header,
+        variable_uses=[(use.name, use.kind) for use in variable_uses],
+        free_vars=frozenset(free_vars),
+        sets_vars=frozenset(scope_root.symbols),
+        exposes=frozenset(exposes),
+    )
+
+
+def combine_statements(statements):
+    """
+    Combine the analysis of the top-level statements into the analysis of the whole code,
+    with the same results as analyzing it at once.
+    """
+    # function and class definitions are visited before the rest of the global scope
+    variable_uses = [VariableUsage(name=analysis.header, kind=VariableUsage.Kind.SET)
+                     for _, analysis in statements if analysis.header is not None]
+    sets_vars = set()
+    depends = set()
+    exposes = set()
+
+    for _, analysis in statements:
+        variable_uses.extend(VariableUsage(name=name, kind=kind)
+                             for name, kind in analysis.variable_uses)
+        sets_vars.update(analysis.sets_vars)
+        exposes.update(analysis.exposes)
+
+    depends.update(unresolved_reads(variable_uses))
+    for _, analysis in statements:
+        depends.update(analysis.free_vars - sets_vars)
+
+    return Analysis(depends=depends, exposes=exposes, scope_root=None)
+
+
+class AnalysisCache:
+    """
+    A bounded LRU cache of analysis results, keyed by a hash of the code.
+    Optionally persisted to disk (with save/load), so a restarted process can start warm.
+    Cached scope trees don't keep their AST unless keep_ast is set.
+    """
+    def __init__(self, maxsize=1024, path=None, keep_ast=False):
+        self.maxsize = maxsize
+        self.path = path
+        self.keep_ast = keep_ast
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, code):
+        return self.key(code) in self._entries
+
+    @staticmethod
+    def key(code):
+        """
+        The key of the code in the cache.
+        """
+        return hashlib.sha256(code.encode('utf-8')).hexdigest()
+
+    def get(self, code):
+        """
+        Get the analysis of the code, analyzing it only if it isn't cached already.
+        Cached results are shared, so their sets are frozen.
+        """
+        key = self.key(code)
+
+        try:
+            result = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            result = analyze(code, keep_ast=self.keep_ast)
+            result = Analysis(
+                depends=frozenset(result.depends),
+                exposes=frozenset(result.exposes),
+                scope_root=result.scope_root,
+            )
+            self._entries[key] = result
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        else:
+            self.hits += 1
+            self._entries.move_to_end(key)
+
+        return result
+
+    def add(self, code, depends, exposes):
+        """Cache the analysis of code that was analyzed elsewhere (eg. in the process pool)."""
+        self.misses += 1
+        self._entries[self.key(code)] = Analysis(
+            depends=frozenset(depends), exposes=frozenset(exposes), scope_root=None)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def stats(self):
+        """
+        Counters of the cache usage.
+        """
+        return dict(hits=self.hits, misses=self.misses, size=len(self), maxsize=self.maxsize)
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def save(self, path=None):
+        """
+        Persist the cache entries to disk (atomically replacing the previous file).
+        """
+        path = path or self.path
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(list(self._entries.items()), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    def load(self, path=None):
+        """
+        Load cache entries persisted with save. A missing file just means a cold cache.
+        """
+        path = path or self.path
+        try:
+            with open(path, 'rb') as f:
+                entries = pickle.load(f)
+        except FileNotFoundError:
+            return
+
+        for key, result in entries[-self.maxsize:]:
+            self._entries[key] = result
+            self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+
+# process-wide analysis cache
+cache = AnalysisCache()
+# process-wide pool of analysis processes
+pool = AnalysisPool()
+
 
 def find_missing_vars(code):
     """
     Find missing variables.
+    Accepts either source code or an already built scope tree (to avoid parsing again).
     """
-    ast_root = ast.parse(code)
-    scope_root = ScopeTreeNode.build_from_ast_node(ast_root)
+    if isinstance(code, ScopeTreeNode):
+        scope_root = code
+    else:
+        ast_root = ast.parse(code)
+        scope_root = ScopeTreeNode.build_from_ast_node(ast_root)
 
     missing_vars = set()
 
@@ -39,28 +385,36 @@ def find_missing_vars(code):
     while pending:
         scope = pending.pop()
 
-        # check the variable operations in order, to detect uses before definitions
-        known_vars = set()
-        for var_use in scope.variable_uses:
-            if var_use.kind == VariableUsage.Kind.SET:
-                known_vars.add(var_use.name)
-            elif var_use.name not in known_vars and var_use.name not in BUILTINS:
-                if not scope.variable_in_parent_scopes(var_use.name):
-                    missing_vars.add(var_use.name)
-            elif var_use.kind == VariableUsage.Kind.DEL:
-                known_vars.remove(var_use.name)
+        for name in unresolved_reads(scope.variable_uses):
+            if not scope.variable_in_parent_scopes(name):
+                missing_vars.add(name)
 
         pending.extend(scope.children)
 
     return missing_vars
 
 
-@attr.s
+def unresolved_reads(variable_uses):
+    """
+    Iterate over the names used in a scope that aren't defined in it (nor builtins).
+    """
+    # check the variable operations in order, to detect uses before definitions
+    known_vars = set()
+    for var_use in variable_uses:
+        if var_use.kind == VariableUsage.Kind.SET:
+            known_vars.add(var_use.name)
+        elif var_use.name not in known_vars and var_use.name not in BUILTINS:
+            yield var_use.name
+        elif var_use.kind == VariableUsage.Kind.DEL:
+            known_vars.remove(var_use.name)
+
+
+@attr.s(slots=True)
 class VariableUsage:
     """
     A use of a variable in the code.
     """
-    class Kind(Enum):
+    class Kind(IntEnum):
         """
         Kind of variable usage (read it, set it, etc).
         """
@@ -73,12 +427,12 @@ class VariableUsage:
     kind = attr.ib()
 
 
-@attr.s
+@attr.s(slots=True)
 class ScopeTreeNode:
     """
     A node in the scopes tree, representing a level of variables scope.
     """
-    class Kind(Enum):
+    class Kind(IntEnum):
         """
         Kind of scope (global scope behaves different from local scopes, etc).
         """
@@ -89,8 +443,12 @@ class ScopeTreeNode:
     ast_node = attr.ib()
     parent = attr.ib(default=None)
     children = attr.ib(default=attr.Factory(list))
-    sets_vars = attr.ib(default=attr.Factory(list))
     variable_uses = attr.ib(default=attr.Factory(list))
+    # symbol table of the scope: name -> index in variable_uses of its first SET
+    symbols = attr.ib(default=attr.Factory(dict))
+    # kept so the tree can still be described after the ast nodes are dropped
+    node_type = attr.ib(default=attr.Factory(lambda self: type(self.ast_node).__name__,
+                                             takes_self=True))
 
     def print_as_tree(self, indentation=0):
         """
@@ -98,17 +456,31 @@ class ScopeTreeNode:
         """
         uses = ('{kind}:{name}'.format(kind=use.kind.name, name=use.name)
                 for use in self.variable_uses)
-        print(' ' * indentation, self.ast_node.__class__.__name__,
+        print(' ' * indentation, self.node_type,
               self.kind.name, ', '.join(uses))
 
         for child in self.children:
             child.print_as_tree(indentation=indentation + 2)
 
+    def drop_ast(self):
+        """
+        Drop the references to the ast nodes in the whole tree, so the AST can be freed once the
+        analysis is done.
+        """
+        pending = [self]
+        while pending:
+            scope = pending.pop()
+            scope.ast_node = None
+            pending.extend(scope.children)
+
     @classmethod
-    def build_from_ast_node(cls, root_ast_node):
+    def build_from_ast_node(cls, root_ast_node, is_optional=False, exposes=None):
         """
         Build a tree of scopes with their variables.
         Non-recursive implementation, it's more complex but avoids max recursion errors.
+        is_optional tells if the root code is already optional (eg. when it's analyzed on its own
+        but comes after an if).
+        When an exposes set is given, the names assigned anywhere in the tree are added to it.
         """
         assert isinstance(root_ast_node, ast.Module)
 
@@ -120,12 +492,20 @@ class ScopeTreeNode:
         # each pending element is composed of 3 parts:
         # nearest parent scope, ast node, optional or not
         # (optional code is code in a block that can be not ran, so the deletes should be ignored)
-        pending = [(root_scope_node, root_ast_node, False)]
+        # pending is used as a stack: children are pushed in reverse, so they are popped in
+        # source order and before their following siblings (a pre-order traversal), in constant
+        # time per node
+        pending = [(root_scope_node, root_ast_node, is_optional)]
 
         while pending:
-            scope_node, ast_node, is_optional = pending.pop(0)
+            scope_node, ast_node, is_optional = pending.pop()
             new_children = []
 
+            if isinstance(ast_node, ast.Try):
+                finalbody = set(map(id, ast_node.finalbody))
+            else:
+                finalbody = ()
+
             for child_ast_node in ast.iter_child_nodes(ast_node):
                 child_scope = scope_node
 
@@ -137,19 +517,38 @@ class ScopeTreeNode:
                     child_scope = scope_node.visit_child_function(child_ast_node)
                 elif isinstance(child_ast_node, ast.ClassDef):
                     child_scope = scope_node.visit_child_class(child_ast_node)
-                elif isinstance(child_ast_node, (ast.If, ast.While, ast.For, ast.Try)):
+                elif isinstance(child_ast_node, OPTIONAL_STATEMENTS):
                     is_optional = True
+                elif isinstance(child_ast_node, ast.Assign) and exposes is not None:
+                    # collected in the same traversal, so nobody needs to walk the AST again
+                    exposes.update(
+                        target.id for target in child_ast_node.targets
+                        if isinstance(target, ast.Name))
 
                 # ...but if I'm the "finally" from a try-except, I'm no longer optional
-                if isinstance(ast_node, ast.Try) and child_ast_node in ast_node.finalbody:
+                if id(child_ast_node) in finalbody:
                     is_optional = False
 
                 new_children.append((child_scope, child_ast_node, is_optional))
 
-            pending = new_children + pending
+            new_children.reverse()
+            pending.extend(new_children)
 
         return root_scope_node
 
+    def add_variable_use(self, name, kind):
+        """
+        Log a variable use in this scope, keeping the symbol table up to date.
+        """
+        if kind == VariableUsage.Kind.SET and name not in self.symbols:
+            self.symbols[name] = len(self.variable_uses)
+
+        # names are interned, so the many uses of a name share a single string
+        self.variable_uses.append(VariableUsage(
+            name=sys.intern(name),
+            kind=kind,
+        ))
+
     def visit_child_name(self, ast_node, is_optional):
         """
         Variable being used in child ast node, infor it to us (current scope).
@@ -165,10 +564,7 @@ class ScopeTreeNode:
             use_kind = VariableUsage.Kind.UNKNOWN
 
         # log the variable usage being done in our scope
-        self.variable_uses.append(VariableUsage(
-            name=var_name,
-            kind=use_kind,
-        ))
+        self.add_variable_use(var_name, use_kind)
 
         return self
 
@@ -176,10 +572,7 @@ class ScopeTreeNode:
         """
         Argument being defined in child ast node, treat it as a variable being set.
         """
-        self.variable_uses.append(VariableUsage(
-            name=ast_node.arg,
-            kind=VariableUsage.Kind.SET,
-        ))
+        self.add_variable_use(ast_node.arg, VariableUsage.Kind.SET)
 
         return self
 
@@ -189,10 +582,7 @@ class ScopeTreeNode:
         a new scope for the child node.
         """
         # log the new variable being created in our scope
-        self.variable_uses.append(VariableUsage(
-            name=ast_node.name,
-            kind=VariableUsage.Kind.SET,
-        ))
+        self.add_variable_use(ast_node.name, VariableUsage.Kind.SET)
 
         # the child is creating its own scope for its children
         child_scope = ScopeTreeNode(
@@ -210,10 +600,7 @@ class ScopeTreeNode:
         a new scope for the child node.
         """
         # log the new variable being created in our scope
-        self.variable_uses.append(VariableUsage(
-            name=ast_node.name,
-            kind=VariableUsage.Kind.SET,
-        ))
+        self.add_variable_use(ast_node.name, VariableUsage.Kind.SET)
 
         # the child is creating its own scope for its children
         child_scope = ScopeTreeNode(
@@ -225,16 +612,15 @@ class ScopeTreeNode:
 
         return child_scope
 
-    def variable_in_parent_scopes(self, variable_name):
+    def variable_in_parent_scopes(self, variable_name, until=None):
         """
-        Find out if a variable exists in the parent scopes of this scope.
+        Find out if a variable exists in the parent scopes of this scope (up to, but not
+        including, the until scope).
         """
         scope = self.parent
 
-        while scope is not None:
-            variables_set = set(use.name for use in scope.variable_uses
-                                if use.kind == VariableUsage.Kind.SET)
-            if variable_name in variables_set:
+        while scope is not until:
+            if variable_name in scope.symbols:
                 return True
             else:
                 scope = scope.parent
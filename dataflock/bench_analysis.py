@@ -0,0 +1,156 @@
+"""
+Benchmarks for the code analysis.
+
+Run with: python bench_analysis.py <benchmark> [--options]
+"""
+import ast
+import enum
+import timeit
+import tracemalloc
+
+import attr
+import fire
+
+import analysis
+
+
+def make_cell(statements):
+    """
+    Build a cell with the given amount of statements, mixing reads, writes and nested scopes.
+    """
+    lines = []
+    for i in range(statements):
+        if i % 10 == 0:
+            lines.append("def func_{i}(arg):\n    local = arg + v_{i}\n    return local".format(i=i))
+        else:
+            lines.append("v_{i} = v_{prev} + missing_{i} * {i}".format(i=i, prev=i - 1))
+    return "\n".join(lines)
+
+
+def two_pass(code):
+    """
+    The previous way of analyzing a cell: one parse for the depends, another for the exposes.
+    """
+    depends = analysis.find_missing_vars(code)
+    exposes = set()
+    for n in ast.walk(ast.parse(code)):
+        if isinstance(n, ast.Assign):
+            for name in n.targets:
+                exposes.add(name.id)
+    return depends, exposes
+
+
+def cell_size(sizes=(10, 100, 1000, 5000), repeat=5):
+    """
+    Per-cell analysis time against cell size, single pass vs two passes.
+    """
+    print("{:>10} {:>10} {:>14} {:>14}".format("stmts", "chars", "2-pass ms", "1-pass ms"))
+    for size in sizes:
+        code = make_cell(size)
+        old = min(timeit.repeat(lambda: two_pass(code), number=1, repeat=repeat))
+        new = min(timeit.repeat(lambda: analysis.analyze(code), number=1, repeat=repeat))
+        print("{:>10} {:>10} {:>14.3f} {:>14.3f}".format(size, len(code), old * 1000, new * 1000))
+
+
+def make_literal(nodes):
+    """
+    Build a generated cell with a large data literal, of approximately the given amount of nodes.
+    """
+    # every element of the dict adds a key and a value node
+    return "config = {" + ", ".join("'k{i}': {i}".format(i=i) for i in range(nodes // 2)) + "}"
+
+
+def ast_scaling(sizes=(10000, 100000, 1000000), repeat=3):
+    """
+    Time to build the scope tree against the amount of AST nodes.
+    """
+    print("{:>10} {:>14} {:>14}".format("nodes", "build ms", "us/node"))
+    for size in sizes:
+        tree = ast.parse(make_literal(size))
+        nodes = sum(1 for _ in ast.walk(tree))
+        elapsed = min(timeit.repeat(
+            lambda: analysis.ScopeTreeNode.build_from_ast_node(tree), number=1, repeat=repeat))
+        print("{:>10} {:>14.1f} {:>14.3f}".format(nodes, elapsed * 1000, elapsed * 1e6 / nodes))
+
+
+@attr.s
+class BaselineVariableUsage:
+    """A variable use as it was stored before: a dict-backed object with an Enum kind."""
+    class Kind(enum.Enum):
+        READ = 1
+        SET = 2
+        DEL = 3
+        UNKNOWN = 4
+
+    name = attr.ib()
+    kind = attr.ib()
+
+
+@attr.s
+class BaselineScopeTreeNode:
+    """A scope as it was stored before: dict-backed, with an (always empty) sets_vars list."""
+    class Kind(enum.Enum):
+        GLOBAL = 0
+        LOCAL = 1
+
+    kind = attr.ib()
+    ast_node = attr.ib()
+    parent = attr.ib(default=None)
+    children = attr.ib(default=attr.Factory(list))
+    sets_vars = attr.ib(default=attr.Factory(list))
+    variable_uses = attr.ib(default=attr.Factory(list))
+
+
+def baseline_analyze(code):
+    """
+    The analysis with the scope tree stored as before, copied from the current one (the copy
+    keeps the AST and the names of the AST nodes, like the previous tree did).
+    """
+    result = analysis.analyze(code)
+    pending = [(result.scope_root, None)]
+    root = None
+    while pending:
+        scope, parent = pending.pop()
+        copy = BaselineScopeTreeNode(
+            kind=BaselineScopeTreeNode.Kind(scope.kind.value),
+            ast_node=scope.ast_node,
+            parent=parent,
+            variable_uses=[BaselineVariableUsage(name=use.name,
+                                                 kind=BaselineVariableUsage.Kind(use.kind.value))
+                           for use in scope.variable_uses],
+        )
+        if parent is None:
+            root = copy
+        else:
+            parent.children.append(copy)
+        pending.extend((child, copy) for child in reversed(scope.children))
+    return analysis.Analysis(depends=result.depends, exposes=result.exposes, scope_root=root)
+
+
+def memory(cells=200, statements=100):
+    """
+    Resident memory of the analysis results of many cells: the scope tree stored as before
+    against the current one, keeping and dropping the AST.
+    """
+    codes = [make_cell(statements) + "\ncell_{} = 1".format(i) for i in range(cells)]
+    variants = [
+        ("baseline", baseline_analyze),
+        ("keep_ast", lambda code: analysis.analyze(code, keep_ast=True)),
+        ("drop_ast", lambda code: analysis.analyze(code, keep_ast=False)),
+    ]
+
+    baseline = None
+    print("{:>10} {:>12} {:>10}".format("tree", "KiB/cell", "saved"))
+    for name, analyze in variants:
+        tracemalloc.start()
+        results = [analyze(code) for code in codes]
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del results
+        if baseline is None:
+            baseline = current
+        print("{:>10} {:>12.1f} {:>9.0%}".format(name, current / 1024 / cells,
+                                                 1 - current / baseline))
+
+if __name__ == '__main__':
+    fire.Fire()
@@ -0,0 +1,75 @@
+"""
+Benchmarks for the HTTP clients.
+
+Run with: python bench_client.py <benchmark> [--options]
+"""
+import asyncio
+import threading
+import time
+
+import fire
+from aiohttp import web
+
+import aioclient
+import engine
+import server
+
+
+def start_server(port):
+    """Serve the app from a thread (with in-process kernels, to measure the HTTP overhead)."""
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(server.build_app(kernel_factory=engine.KernelProxy), access_log=None)
+    loop.run_until_complete(runner.setup())
+    loop.run_until_complete(web.TCPSite(runner, "localhost", port).start())
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+
+
+async def _setup(url, environments):
+    async with aioclient.AsyncClient(url) as client:
+        names = ["bench{}".format(i) for i in range(environments)]
+        await client.fan_out("create_environment", names)
+        await client.fan_out("create_cell", names, "a = 1")
+    return names
+
+
+async def _async_requests(url, names, requests, concurrency):
+    async with aioclient.AsyncClient(url, limit=concurrency) as client:
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def get(env):
+            async with semaphore:
+                await client.get(env, "a")
+
+        start = time.perf_counter()
+        await asyncio.gather(*[get(names[i % len(names)]) for i in range(requests)])
+        return time.perf_counter() - start
+
+
+def requests_per_second(requests=2000, environments=10, concurrency=(1, 10, 50), port=8765):
+    """
+    Requests per second getting a variable from many environments: sync client one request at
+    a time vs async client with concurrent requests over pooled connections.
+    """
+    url = "http://localhost:{}/".format(port)
+    start_server(port)
+    names = asyncio.run(_setup(url, environments))
+
+    print("{:>8} {:>12} {:>12}".format("client", "concurrency", "requests/s"))
+    try:
+        import client
+    except ImportError:
+        print("{:>8} {:>12} {:>12}".format("sync", 1, "(no requests)"))
+    else:
+        sync = client.Client(url)
+        start = time.perf_counter()
+        for i in range(requests):
+            sync.get(names[i % len(names)], "a")
+        print("{:>8} {:>12} {:>12.0f}".format("sync", 1, requests / (time.perf_counter() - start)))
+
+    for conc in concurrency:
+        elapsed = asyncio.run(_async_requests(url, names, requests, conc))
+        print("{:>8} {:>12} {:>12.0f}".format("async", conc, requests / elapsed))
+
+
+if __name__ == '__main__':
+    fire.Fire()
@@ -0,0 +1,110 @@
+"""
+Benchmarks for the kernels.
+
+Run with: python bench_engine.py <benchmark> [--options]
+"""
+import asyncio
+import contextlib
+import os
+import statistics
+import time
+
+import fire
+
+import engine
+import runner
+
+
+async def _create_and_run(flock, name):
+    """
+    Time until a new environment has run its first cell.
+    """
+    start = time.perf_counter()
+    env = flock.environment_create(name)
+    await env.kernel.run("a = 1", set(), {"a"})
+    elapsed = time.perf_counter() - start
+    flock.environemnt_delete(name)
+    return elapsed
+
+
+async def _latencies(flock, environments, pause):
+    latencies = []
+    for i in range(environments):
+        latencies.append(await _create_and_run(flock, "bench_{}".format(i)))
+        # give the pool some time to refill, like between user requests
+        await asyncio.sleep(pause)
+    return latencies
+
+
+def create_latency(environments=20, pool_size=2, preload=(), pause=0.2):
+    """
+    Environment creation latency (to the first cell run), cold started kernels vs a warm pool.
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    print("{:>10} {:>12} {:>12} {:>12}".format("kernels", "median ms", "p90 ms", "max ms"))
+
+    cold = runner.DataFlock(kernel_factory=engine.SubprocessKernel)
+    pool = engine.KernelPool(size=pool_size, preload=preload)
+    pool.fill()
+    warm = runner.DataFlock(kernel_pool=pool)
+    try:
+        for name, flock in (("cold", cold), ("pooled", warm)):
+            latencies = sorted(loop.run_until_complete(_latencies(flock, environments, pause)))
+            print("{:>10} {:>12.1f} {:>12.1f} {:>12.1f}".format(
+                name,
+                statistics.median(latencies) * 1000,
+                latencies[int(len(latencies) * 0.9) - 1] * 1000,
+                latencies[-1] * 1000))
+    finally:
+        pool.close()
+        # let the killed kernels' listeners finish
+        loop.run_until_complete(asyncio.sleep(0.1))
+        loop.close()
+
+
+class CopyingKernelProxy(engine.KernelProxy):
+    """
+    The previous way of running a cell: copy the inputs to a dict, run it with the globals of the
+    engine and print the whole state.
+    """
+    async def run(self, code, depends, exposes, cell_id=None, timeout=None, cpu_timeout=None):
+        local_vars = dict((k, self.variables[k]) for k in depends)
+        await asyncio.sleep(0)
+        print("execing", code, local_vars)
+        exec(code, vars(engine), local_vars)
+        print("execd", code, local_vars)
+        self.variables.update(dict((k, local_vars[k]) for k in exposes))
+        print("final_state", self.variables)
+
+
+async def _run_cells(kernel, cells):
+    for i in range(cells):
+        await kernel.run("t_{i} = s_{i} + 1".format(i=i), {"s_{}".format(i)}, {"t_{}".format(i)})
+
+
+def tiny_cells(cells=1000, state=10000, value_size=100):
+    """
+    Cells per second running tiny cells in a kernel with a large state (state variables of
+    value_size items each).
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    print("{:>10} {:>12} {:>14}".format("kernel", "cells/s", "us/cell"))
+    for name, kernel in (("copying", CopyingKernelProxy()), ("namespace", engine.KernelProxy())):
+        for i in range(state):
+            kernel.variables["s_{}".format(i)] = list(range(value_size)) if i >= cells else i
+
+        # the printed state goes nowhere, only formatting it is measured
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            start = time.perf_counter()
+            loop.run_until_complete(_run_cells(kernel, cells))
+            elapsed = time.perf_counter() - start
+        print("{:>10} {:>12.0f} {:>14.1f}".format(name, cells / elapsed, elapsed * 1e6 / cells))
+    loop.close()
+
+
+if __name__ == '__main__':
+    fire.Fire()
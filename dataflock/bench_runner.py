@@ -0,0 +1,102 @@
+"""
+Benchmarks for the environment runner.
+
+Run with: python bench_runner.py <benchmark> [--options]
+"""
+import random
+import time
+
+import fire
+
+import analysis
+import runner
+
+
+def make_notebook(cells, statements=50):
+    """
+    Build the code of a notebook, where every cell uses variables from some previous cells.
+    """
+    codes = []
+    for i in range(cells):
+        lines = ["tmp_{i}_{j} = {j} * {j}".format(i=i, j=j) for j in range(statements)]
+        inputs = " + ".join("var_{}".format(k) for k in (i - 1, i // 2, i // 3) if 0 <= k < i)
+        lines.append("var_{} = {}".format(i, inputs or "0"))
+        codes.append("\n".join(lines))
+    return codes
+
+
+def new_env():
+    env = runner.DataFlock().environment_create("bench")
+    env.set_dryrun()
+    return env
+
+
+def bulk_import(cells=1000, statements=50, max_workers=None):
+    """
+    Cells per second importing a notebook, one cell at a time vs in bulk.
+    """
+    codes = make_notebook(cells, statements)
+
+    env = new_env()
+    start = time.perf_counter()
+    for code in codes:
+        env.cell_create(analysis.Cell(code))
+    serial = time.perf_counter() - start
+
+    env = new_env()
+    start = time.perf_counter()
+    env.cells_import(codes, max_workers=max_workers)
+    bulk = time.perf_counter() - start
+
+    print("one by one: {:>10.1f} cells/s".format(cells / serial))
+    print("bulk:       {:>10.1f} cells/s".format(cells / bulk))
+
+
+class WalkLoopCheckRunner(runner.EnvironemntRunner):
+    """
+    The previous loop check: walk every cell downstream of the new cell on each change.
+    """
+    def raise_if_loop(self, cell, cell_id):
+        start = set()
+        for var in cell.exposes:
+            start.update(self.depends(var))
+
+        for c in start:
+            for n in self.walk(c):
+                if self.cells[n].exposes.intersection(cell.depends):
+                    raise ValueError("Loop")
+
+
+def loop_check(cells=10000, updates=200, seed=0):
+    """
+    Time per cell insertion and per interface changing update, on a graph of many cells.
+    """
+    rng = random.Random(seed)
+    codes = []
+    for i in range(cells):
+        inputs = set(rng.randrange(i) for _ in range(3)) if i else ()
+        codes.append("var_{} = {}".format(i, " + ".join("var_{}".format(j) for j in inputs) or "0"))
+    changes = []
+    for _ in range(updates):
+        i = rng.randrange(1, cells // 10)
+        changes.append((i, codes[i] + " + var_{}".format(rng.randrange(i))))
+    parsed = [analysis.Cell(code) for code in codes]
+    changes = [(i, analysis.Cell(code)) for i, code in changes]
+
+    for name, env in [("walk", WalkLoopCheckRunner()), ("incremental", runner.EnvironemntRunner())]:
+        env.set_dryrun()
+        start = time.perf_counter()
+        cids = [env.cell_create(cell, live=False) for cell in parsed]
+        inserts = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for i, cell in changes:
+            env.cell_update(cids[i], cell, live=False)
+        changing = time.perf_counter() - start
+
+        print("{:<12} {:>10.1f} us/insert {:>10.1f} us/update".format(
+            name, inserts * 1e6 / cells, changing * 1e6 / updates))
+
+
+if __name__ == '__main__':
+    fire.Fire()
@@ -0,0 +1,97 @@
+"""
+Benchmarks for the subprocess RPC.
+
+Run with: python bench_subrpc.py <benchmark> [--options]
+"""
+import asyncio
+import pickle
+import time
+
+import fire
+
+import subrpc
+
+
+class EchoSlave(subrpc.SubRPCSlave):
+    async def do_echo(self, what):
+        return what
+
+    async def do_make(self, size, out_of_band):
+        data = bytearray(size)
+        # like numpy arrays, that are pickled out-of-band with protocol 5
+        return pickle.PickleBuffer(data) if out_of_band else data
+
+
+async def _timed_call(rpc, what):
+    start = time.perf_counter()
+    await rpc.do_echo(what)
+    return time.perf_counter() - start
+
+
+async def _run(rpc, calls, concurrency, what):
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(calls // concurrency):
+        latencies += await asyncio.gather(*[_timed_call(rpc, what) for _ in range(concurrency)])
+    return time.perf_counter() - start, sorted(latencies)
+
+
+def calls(calls=10000, concurrency=(1, 10, 100), size=10):
+    """
+    Calls per second and p99 latency of small calls, one message per call vs framed batches.
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    what = "x" * size
+
+    print("{:>8} {:>12} {:>12} {:>12}".format("mode", "concurrency", "calls/s", "p99 ms"))
+    for framed in (False, True):
+        rpc = subrpc.get_master_for(EchoSlave, framed=framed)
+        try:
+            # warm up, so the process start isn't measured
+            loop.run_until_complete(rpc.do_echo(what))
+            for conc in concurrency:
+                elapsed, latencies = loop.run_until_complete(_run(rpc, calls, conc, what))
+                print("{:>8} {:>12} {:>12.0f} {:>12.3f}".format(
+                    "framed" if framed else "pickled", conc,
+                    len(latencies) / elapsed,
+                    latencies[int(len(latencies) * 0.99) - 1] * 1000))
+        finally:
+            rpc.kill()
+    loop.run_until_complete(asyncio.sleep(0.1))
+    loop.close()
+
+
+def transfer(sizes=(1 << 20, 16 << 20, 256 << 20, 1 << 30), repeat=3):
+    """
+    Time to get a big buffer from the slave: pickled, framed through the pipe and shared memory.
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    modes = (
+        ("pickled", dict(framed=False)),
+        ("pipe", dict(framed=True)),
+        ("shared", dict(framed=True, shared_threshold=subrpc.SHARED_THRESHOLD)),
+    )
+
+    print("{:>8} {:>12} {:>12} {:>12}".format("mode", "MiB", "ms", "MiB/s"))
+    for name, options in modes:
+        rpc = subrpc.get_master_for(EchoSlave, **options)
+        try:
+            for size in sizes:
+                elapsed = float("inf")
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    value = loop.run_until_complete(rpc.do_make(size, rpc.framed))
+                    elapsed = min(elapsed, time.perf_counter() - start)
+                    del value
+                print("{:>8} {:>12.0f} {:>12.1f} {:>12.0f}".format(
+                    name, size / (1 << 20), elapsed * 1000, size / (1 << 20) / elapsed))
+        finally:
+            rpc.kill()
+    loop.run_until_complete(asyncio.sleep(0.1))
+    loop.close()
+
+
+if __name__ == '__main__':
+    fire.Fire()
@@ -6,33 +6,88 @@ class Client(object):
 
     def __init__(self, server="http://localhost:8080/"):
         self._server = server
+        # keeps the connections open between requests
+        self._session = requests.Session()
 
     def list_environments(self):
-        r = requests.get(self._server)
+        r = self._session.get(self._server)
         r.raise_for_status()
         return r.text
 
-    def create_environment(self, name):
-        r = requests.post(self._server, json={'name': name})
+    def create_environment(self, name, timeout=None, cpu_timeout=None):
+        r = self._session.post(
+            self._server,
+            json={'name': name, 'timeout': timeout, 'cpu_timeout': cpu_timeout})
         r.raise_for_status()
         return r.text
 
     def create_cell(self, environment, code, live=True):
-        r = requests.post(
+        r = self._session.post(
             self._server + environment + '/cells', 
             json={'code': code, 'live': live})
         r.raise_for_status()
         return r.text
 
     def update_cell(self, environment, cell_id, code, live=True):
-        r = requests.post(
+        r = self._session.post(
             self._server + environment + "/cells/" + cell_id, 
             json={'code': code, 'live': live})
         r.raise_for_status()
         return r.text
 
-    def get(self, environment, name):
-        r = requests.get(self._server + environment + "/variables/" + name)
+    def get(self, environment, name, start=None, stop=None):
+        r = self._session.get(
+            self._server + environment + "/variables/" + name,
+            params={'start': start, 'stop': stop})
+        r.raise_for_status()
+        return r.text
+
+    def poll(self, environment, name, version=None, wait=None):
+        """
+        Get a variable only if it changed since version: returns (version, value), with None
+        as the value if it didn't. With wait, waits for a change up to wait seconds.
+        """
+        params = {}
+        headers = {}
+        if version is not None:
+            headers['If-None-Match'] = '"{}"'.format(version)
+            if wait is not None:
+                params = {'after': version, 'timeout': wait}
+        r = self._session.get(
+            self._server + environment + "/variables/" + name,
+            params=params, headers=headers)
+        r.raise_for_status()
+        version = int(r.headers['ETag'].strip('"'))
+        return version, (None if r.status_code == 304 else r.text)
+
+    def get_many(self, environment, names):
+        r = self._session.get(
+            self._server + environment + "/variables",
+            params={'name': list(names)})
+        r.raise_for_status()
+        return r.text
+
+    def update_cells(self, environment, cells, live=True):
+        """
+        Create and update many cells in one request, atomically. cells are dicts with the code,
+        and the id of the cell to update (none to create it).
+        """
+        r = self._session.post(
+            self._server + environment + "/batch/cells",
+            json={'cells': list(cells), 'live': live})
+        r.raise_for_status()
+        return r.text
+
+    def create_cells(self, environment, codes, live=True):
+        return self.update_cells(environment, [{'code': code} for code in codes], live)
+
+    def usage(self, environment):
+        r = self._session.get(self._server + environment + "/usage")
+        r.raise_for_status()
+        return r.text
+
+    def interrupt(self, environment):
+        r = self._session.post(self._server + environment + "/interrupt")
         r.raise_for_status()
         return r.text
 
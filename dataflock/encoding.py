@@ -0,0 +1,186 @@
+"""
+Incremental encoders for variable values, so big values are sent as they are encoded instead of
+being turned into one big string first.
+
+Every encoder is a generator of bytes chunks. The binary formats need optional packages: when one
+isn't installed its format isn't offered.
+"""
+import json
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+# encoders join their output into chunks of about this many bytes
+CHUNK_SIZE = 1 << 16
+
+JSON = "application/json"
+NPY = "application/x-npy"
+ARROW = "application/vnd.apache.arrow.stream"
+MSGPACK = "application/msgpack"
+
+
+def chunked(parts, size=CHUNK_SIZE):
+    """Join small bytes parts in chunks of at least size bytes (except the last one)."""
+    chunk = []
+    length = 0
+    for part in parts:
+        chunk.append(part)
+        length += len(part)
+        if length >= size:
+            yield b"".join(chunk)
+            chunk = []
+            length = 0
+    if chunk:
+        yield b"".join(chunk)
+
+
+def to_builtin(value):
+    """
+    Convert the values JSON and msgpack can't encode, when it can be done without losing data
+    (numpy arrays and scalars). Anything else is a TypeError, the value needs another format.
+    """
+    if numpy is not None:
+        if isinstance(value, numpy.ndarray):
+            return value.tolist()
+        if isinstance(value, numpy.generic):
+            return value.item()
+    raise TypeError("Values of type {} can't be encoded in this format".format(
+        type(value).__name__))
+
+
+def encode_json(value):
+    encoder = json.JSONEncoder(default=to_builtin)
+    return chunked(part.encode() for part in encoder.iterencode(value))
+
+
+def encode_npy(value):
+    array = numpy.ascontiguousarray(value)
+    if array.dtype.hasobject:
+        raise TypeError("arrays of objects can't be encoded as npy")
+
+    header = numpy.lib.format.header_data_from_array_1_0(array)
+    stream = _BytesSink()
+    numpy.lib.format.write_array_header_1_0(stream, header)
+    yield stream.take()
+
+    data = memoryview(array.reshape(-1)).cast("B")
+    for start in range(0, len(data), CHUNK_SIZE):
+        yield bytes(data[start:start + CHUNK_SIZE])
+
+
+def encode_arrow(value):
+    if isinstance(value, pyarrow.Table):
+        table = value
+    elif hasattr(value, "to_arrow"):
+        table = value.to_arrow()
+    elif type(value).__module__.startswith("pandas"):
+        table = pyarrow.Table.from_pandas(value)
+    else:
+        table = pyarrow.table({"value": pyarrow.array(value)})
+
+    sink = _BytesSink()
+    with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+        yield sink.take()
+        for batch in table.to_batches(max_chunksize=CHUNK_SIZE):
+            writer.write_batch(batch)
+            yield sink.take()
+    yield sink.take()
+
+
+def encode_msgpack(value):
+    packer = msgpack.Packer(default=to_builtin)
+    if isinstance(value, (list, tuple)):
+        # the items are packed one by one
+        return chunked(_msgpack_items(packer, value))
+    return iter([packer.pack(value)])
+
+
+def _msgpack_items(packer, items):
+    yield packer.pack_array_header(len(items))
+    for item in items:
+        yield packer.pack(item)
+
+
+class _BytesSink:
+    """A file-like object collecting what is written, until taken."""
+    def __init__(self):
+        self.parts = []
+        self.closed = False
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        data = b"".join(self.parts)
+        self.parts = []
+        return data
+
+
+def formats():
+    """The media types that can be encoded, with their encoders, preferred first."""
+    available = [(JSON, encode_json)]
+    if numpy is not None:
+        available.append((NPY, encode_npy))
+    if pyarrow is not None:
+        available.append((ARROW, encode_arrow))
+    if msgpack is not None:
+        available.append((MSGPACK, encode_msgpack))
+    return available
+
+
+def parse_accept(accept):
+    """The (media type, quality) of an Accept header, best first."""
+    accepted = []
+    for position, item in enumerate(accept.split(",")):
+        media_type, *params = [part.strip() for part in item.split(";")]
+        if not media_type:
+            continue
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted.append((-quality, position, media_type.lower()))
+    return [(media_type, -quality) for quality, _, media_type in sorted(accepted)]
+
+
+def negotiate(accept):
+    """
+    The (media type, encoder) to answer a request with this Accept header, or None if none of
+    the accepted formats can be encoded. JSON is the default.
+    """
+    available = formats()
+    if not accept:
+        return available[0]
+    aliases = {"application/x-msgpack": MSGPACK}
+    for media_type, quality in parse_accept(accept):
+        if quality <= 0:
+            continue
+        media_type = aliases.get(media_type, media_type)
+        for candidate in available:
+            if media_type in ("*/*", "application/*") or candidate[0] == media_type:
+                return candidate
+    return None
@@ -1,33 +1,616 @@
 import multiprocessing
 import json
 import asyncio
+import contextlib
+import functools
+import hashlib
+import importlib
+import io
+import os
+import resource
+import signal
+import threading
+import time
+import pickle
+from collections import OrderedDict, deque, namedtuple
+
+import subrpc
+
+
+class CellTimeout(Exception):
+    """The cell ran longer than its wall clock or CPU timeout."""
+
+
+class CellInterrupted(Exception):
+    """The kernel was interrupted before the cell started running."""
+
+
+class KernelRestarted(Exception):
+    """The kernel didn't stop the cell in time and was restarted, its variables are lost."""
+
+
+@contextlib.contextmanager
+def time_limits(timeout=None, cpu_timeout=None):
+    """
+    Raise CellTimeout in the code running in the block after timeout seconds (wall clock) or
+    cpu_timeout seconds of CPU time.
+    The timers are signals, so they only work in the main thread (elsewhere there are no limits).
+    """
+    timers = [(signal.ITIMER_REAL, signal.SIGALRM, timeout, "wall clock"),
+              (signal.ITIMER_PROF, signal.SIGPROF, cpu_timeout, "CPU")]
+    timers = [timer for timer in timers if timer[2]]
+    if not timers or threading.current_thread() is not threading.main_thread():
+        yield
+        return
+
+    def on_timeout(signum, frame):
+        for _, sig, seconds, kind in timers:
+            if sig == signum:
+                raise CellTimeout("Cell exceeded its {} timeout of {}s".format(kind, seconds))
+
+    handlers = {}
+    for which, sig, seconds, _ in timers:
+        handlers[sig] = signal.signal(sig, on_timeout)
+        signal.setitimer(which, seconds)
+    try:
+        yield
+    finally:
+        for which, sig, _, _ in timers:
+            signal.setitimer(which, 0)
+            signal.signal(sig, handlers[sig])
+
+
+class ResourceLimits(namedtuple('ResourceLimits', ['memory', 'cpu', 'address_space', 'window'],
+                                defaults=(None, None, None, 10.0))):
+    """
+    Limits of a kernel process (None for no limit):
+    memory: resident memory in bytes, the kernel is restarted when it goes over it.
+    cpu: share of a CPU (eg. 0.5) the kernel can use on average over window seconds, the kernel is
+        restarted when it goes over it.
+    address_space: the RLIMIT_AS of the kernel process in bytes, allocations over it fail with
+        MemoryError.
+    """
+
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = resource.getpagesize()
+
+
+def process_usage(pid):
+    """The resident memory (bytes) and CPU time (seconds) of a process, from /proc."""
+    with open("/proc/{}/stat".format(pid)) as stat:
+        # the command name (in parentheses) can have spaces
+        fields = stat.read().rsplit(")", 1)[1].split()
+    with open("/proc/{}/statm".format(pid)) as statm:
+        rss_pages = int(statm.read().split()[1])
+    utime, stime = int(fields[11]), int(fields[12])
+    return rss_pages * PAGE_SIZE, (utime + stime) / CLOCK_TICKS
+
+
+def set_address_space_limit(limit):
+    """Set (or with None, remove) the soft RLIMIT_AS of the current process."""
+    _, hard = resource.getrlimit(resource.RLIMIT_AS)
+    resource.setrlimit(resource.RLIMIT_AS, (resource.RLIM_INFINITY if limit is None else limit, hard))
+
+
+# cell output is sent in chunks of up to this many characters
+OUTPUT_CHUNK_SIZE = 4096
+
+
+class OutputWriter(io.TextIOBase):
+    """
+    Replaces stdout/stderr while a cell runs, sending what it writes to output(cell_id, stream,
+    text) in chunks.
+    """
+    def __init__(self, output, cell_id, stream, chunk_size=OUTPUT_CHUNK_SIZE):
+        self.output = output
+        self.cell_id = cell_id
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.buffer = []
+        self.buffered = 0
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        self.buffer.append(text)
+        self.buffered += len(text)
+        if self.buffered >= self.chunk_size:
+            self.flush()
+        return len(text)
+
+    def flush(self):
+        text = "".join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        for start in range(0, len(text), self.chunk_size):
+            self.output(self.cell_id, self.stream, text[start:start + self.chunk_size])
+
+
+def fingerprint(value):
+    """
+    A hash of the value, to tell if a cell produced the same value again (None if it can't be
+    pickled). The pickle is hashed as it's written, without keeping it in memory, and buffers
+    (eg. numpy arrays) are hashed in place instead of being copied to the pickle.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+
+    def hash_buffer(buffer):
+        try:
+            digest.update(buffer.raw())
+        except BufferError:
+            # not contiguous, a true value keeps it in the pickle
+            return True
+        return False
+
+    try:
+        pickle.Pickler(_HashWriter(digest), protocol=5, buffer_callback=hash_buffer).dump(value)
+    except Exception:
+        return None
+    return digest.hexdigest()
+
+
+class _HashWriter:
+    """A file-like object hashing what is written to it."""
+    def __init__(self, digest):
+        self.write = digest.update
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_cell(code):
+    return compile(code, "<cell>", "exec")
 
 
 class KernelProxy:
+    """
+    Runs the cells in the server process.
+    The variables of the environment are the globals of the cells, so the cells read their inputs
+    in place; what a cell sets goes to a scope of its own, and only the values it exposes are
+    moved to the environment.
+    """
     def __init__(self):
         self.variables = {}
+        self.fingerprints = {}
+        self.output = None
+        self.memo = None
+        self.memo_size = 0
+        self.fingerprint_values = True
+        # every interrupt drops the runs waiting to start
+        self.interrupts = 0
 
     def interrupt(self):
-        pass
+        self.interrupts += 1
+
+    def busy(self):
+        # the cells run synchronously, once a run is cancelled nothing is left of it
+        return False
 
     def restart(self):
         self.kill()
-        self.restart()
+        self.start()
 
     def start(self):
-        self.variables = {}
+        self.reset()
 
     def kill(self):
         pass
 
-    async def run(self, code, depends, exposes):
-        local_vars = dict((k, self.variables[k]) for k in depends)
+    def set_memo(self, size):
+        """
+        Keep the outputs of up to size cell runs, keyed by the code and the fingerprints of the
+        inputs: running the same code on the same inputs again reuses them (0 to disable).
+        The cell doesn't actually run, so its side effects (output, files...) don't happen again.
+        """
+        self.memo_size = size
+        self.memo = OrderedDict() if size else None
+
+    def set_fingerprints(self, enabled):
+        """
+        Whether to fingerprint the values the cells expose, to tell when they didn't change.
+        They are always fingerprinted with a memo, which needs them.
+        """
+        self.fingerprint_values = enabled
+
+    def memo_key(self, code, depends):
+        inputs = []
+        for varname in sorted(depends):
+            value_fingerprint = self.fingerprints.get(varname)
+            if value_fingerprint is None:
+                return None
+            inputs.append((varname, value_fingerprint))
+        return hashlib.blake2b(code.encode(), digest_size=16).hexdigest(), tuple(inputs)
+
+    def set_output(self, output):
+        """Send what the cells print to output(cell_id, stream, text), instead of stdout."""
+        self.output = output
+
+    def set_on_restart(self, on_restart):
+        pass
+
+    def set_limits(self, limits):
+        # runs in the server process, there's nothing to limit
+        if limits is not None:
+            raise ValueError("Resource limits need a kernel in its own process")
+
+    def usage(self):
+        return {}
+
+    async def run(self, code, depends, exposes, cell_id=None, timeout=None, cpu_timeout=None):
+        """
+        Run the code, returning the fingerprints of the values it exposes and whether they came
+        from the memo.
+        """
+        key = self.memo_key(code, depends) if self.memo is not None else None
+        if key is not None and key in self.memo:
+            self.memo.move_to_end(key)
+            outputs, fingerprints = self.memo[key]
+            self.variables.update(outputs)
+            self.fingerprints.update(fingerprints)
+            return dict(fingerprints=fingerprints, memoized=True)
+
+        compiled = compile_cell(code)
+        scope = {}
+        interrupts = self.interrupts
         await asyncio.sleep(0)
-        print("execing", code, local_vars)
-        exec(code, globals(), local_vars)
-        print("execd", code, local_vars)
-        self.variables.update(dict((k, local_vars[k]) for k in exposes))
-        print("final_state", self.variables)
-
-    def get(self, varname):
-        return self.variables[varname]
+        if self.interrupts != interrupts:
+            raise CellInterrupted("The kernel was interrupted before the cell started")
+        try:
+            with self.capture_output(cell_id), time_limits(timeout, cpu_timeout):
+                exec(compiled, self.variables, scope)
+        finally:
+            # exec adds the builtins to the globals, they aren't a variable of the environment
+            # (the functions of the cell keep their own reference to them)
+            self.variables.pop('__builtins__', None)
+        outputs = dict((k, scope[k]) for k in exposes)
+        self.variables.update(outputs)
+        if self.fingerprint_values or self.memo is not None:
+            fingerprints = dict((k, fingerprint(v)) for k, v in outputs.items())
+        else:
+            # unknown, so the values count as changed
+            fingerprints = dict.fromkeys(outputs)
+        self.fingerprints.update(fingerprints)
+
+        if key is not None:
+            self.memo[key] = (outputs, fingerprints)
+            while len(self.memo) > self.memo_size:
+                self.memo.popitem(last=False)
+        return dict(fingerprints=fingerprints, memoized=False)
+
+    @contextlib.contextmanager
+    def capture_output(self, cell_id):
+        if self.output is None:
+            yield
+            return
+        stdout = OutputWriter(self.output, cell_id, "stdout")
+        stderr = OutputWriter(self.output, cell_id, "stderr")
+        try:
+            with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+                yield
+        finally:
+            stdout.flush()
+            stderr.flush()
+
+    async def get(self, varname, start=None, stop=None):
+        """The value of a variable, or the [start:stop] slice of it (so only that is sent)."""
+        value = self.variables[varname]
+        if start is None and stop is None:
+            return value
+        return value[start:stop]
+
+    def reset(self):
+        """Forget all the variables, leaving the kernel as new."""
+        self.variables = {}
+        self.fingerprints = {}
+        if self.memo is not None:
+            self.memo.clear()
+
+    def preload(self, modules):
+        """Import modules ahead of time, so cells don't have to wait for them."""
+        for module in modules:
+            importlib.import_module(module)
+
+
+class KernelSlave(subrpc.SubRPCSlave):
+    """
+    The side of a SubprocessKernel that runs in the kernel process.
+    """
+    def __init__(self, channel, stdout, stderr):
+        super().__init__(channel, stdout, stderr)
+        self.kernel = KernelProxy()
+        self.kernel.set_output(self.on_output)
+
+    def on_output(self, cell_id, stream, text):
+        queue = self.stdout if stream == "stdout" else self.stderr
+        queue.put((cell_id, text))
+
+    async def do_run(self, code, depends, exposes, cell_id=None, timeout=None, cpu_timeout=None):
+        return await self.kernel.run(code, depends, exposes, cell_id, timeout, cpu_timeout)
+
+    async def do_get(self, varname, start=None, stop=None):
+        return await self.kernel.get(varname, start, stop)
+
+    async def do_reset(self):
+        self.kernel.reset()
+
+    async def do_preload(self, modules):
+        self.kernel.preload(modules)
+
+    async def do_set_address_space_limit(self, limit):
+        set_address_space_limit(limit)
+
+    async def do_set_memo(self, size):
+        self.kernel.set_memo(size)
+
+    async def do_set_fingerprints(self, enabled):
+        self.kernel.set_fingerprints(enabled)
+
+
+class SubprocessKernel:
+    """
+    A kernel running in its own process, talking to it with subrpc.
+    Cells run out of the server process (and in parallel with other environments), and can be
+    interrupted.
+    The kernel runs one cell at a time, so the runs are sent one at a time too: they wait for
+    their turn here, and their wall clock timeout starts when they are sent. A cell that doesn't
+    stop timeout_grace seconds after its wall clock timeout (eg. stuck in C code) gets the
+    kernel restarted.
+    With resource limits, the process is checked every monitor_interval seconds and restarted
+    when it goes over them. A process that dies (eg. a cell calling os._exit) is restarted too.
+    """
+    timeout_grace = 1.0
+    monitor_interval = 0.5
+
+    def __init__(self):
+        # big values (eg. numpy arrays) go through shared memory instead of the pipe
+        self.rpc = subrpc.get_master_for(
+            KernelSlave, framed=True, shared_threshold=subrpc.SHARED_THRESHOLD,
+            on_output=self.on_output, on_died=self.on_died)
+        self.output = None
+        self.on_restart = None
+        self.limits = None
+        self.monitor = None
+        self.preloaded = []
+        self.memo_size = 0
+        self.fingerprint_values = True
+        self.cpu_samples = deque()
+        self.stats = dict(restarts=0, memory_kills=0, cpu_kills=0, deaths=0)
+        self.run_lock = asyncio.Lock()
+        # every interrupt drops the runs waiting for their turn
+        self.interrupts = 0
+        # bumped by every restart, so a late timeout doesn't restart the next process
+        self.generation = 0
+
+    def interrupt(self):
+        self.interrupts += 1
+        self.rpc.interrupt()
+
+    def on_died(self):
+        """The process died by itself: start a new one, the variables are lost."""
+        self.stats['deaths'] += 1
+        self.restart()
+        if self.on_restart is not None:
+            self.on_restart("died")
+
+    def busy(self):
+        """Whether commands were sent that the kernel didn't answer yet (it may be running them)."""
+        return bool(self.rpc.pending_cmds)
+
+    def restart(self):
+        self.rpc.restart()
+        self.generation += 1
+        self.stats['restarts'] += 1
+        self.cpu_samples.clear()
+        # a new process, without the modules and limits of the previous one
+        if self.preloaded:
+            self.rpc.notify('do_preload', self.preloaded)
+        if self.limits is not None and self.limits.address_space is not None:
+            self.rpc.notify('do_set_address_space_limit', self.limits.address_space)
+        if self.memo_size:
+            self.rpc.notify('do_set_memo', self.memo_size)
+        if not self.fingerprint_values:
+            self.rpc.notify('do_set_fingerprints', False)
+
+    def start(self):
+        self.rpc.start()
+
+    def kill(self):
+        if self.monitor is not None:
+            self.monitor.cancel()
+            self.monitor = None
+        self.rpc.kill()
+
+    def set_output(self, output):
+        self.output = output
+
+    def set_on_restart(self, on_restart):
+        """Call on_restart(reason) when the kernel is restarted for going over its limits."""
+        self.on_restart = on_restart
+
+    def set_memo(self, size):
+        if size != self.memo_size:
+            self.memo_size = size
+            self.rpc.notify('do_set_memo', size)
+
+    def set_fingerprints(self, enabled):
+        if enabled != self.fingerprint_values:
+            self.fingerprint_values = enabled
+            self.rpc.notify('do_set_fingerprints', enabled)
+
+    def set_limits(self, limits):
+        """Apply ResourceLimits to the kernel (None for no limits)."""
+        previous, self.limits = self.limits, limits
+        address_space = limits.address_space if limits is not None else None
+        if address_space is not None or (previous is not None and
+                                         previous.address_space is not None):
+            self.rpc.notify('do_set_address_space_limit', address_space)
+
+        self.cpu_samples.clear()
+        if limits is not None and (limits.memory or limits.cpu) and self.monitor is None:
+            self.monitor = asyncio.ensure_future(self.monitor_task())
+
+    async def monitor_task(self):
+        while self.limits is not None and (self.limits.memory or self.limits.cpu):
+            await asyncio.sleep(self.monitor_interval)
+            self.check_limits()
+        self.monitor = None
+
+    def check_limits(self):
+        """Restart the kernel if it's over its limits, returning the reason (or None)."""
+        limits = self.limits
+        if limits is None:
+            return None
+        usage = self.usage()
+        if not usage:
+            return None
+
+        reason = None
+        if limits.memory and usage['rss'] > limits.memory:
+            reason = "memory"
+            self.stats['memory_kills'] += 1
+        elif limits.cpu and usage['cpu'] is not None and usage['cpu'] > limits.cpu:
+            reason = "cpu"
+            self.stats['cpu_kills'] += 1
+        if reason is None:
+            return None
+
+        self.restart()
+        if self.on_restart is not None:
+            self.on_restart(reason)
+        return reason
+
+    def usage(self):
+        """
+        Resident memory (bytes), CPU time (seconds) and CPU share over the limits window of the
+        kernel process, with the restart counters.
+        """
+        try:
+            rss, cpu_time = process_usage(self.rpc.process.pid)
+        except (OSError, ValueError, IndexError):
+            # dead, or not started yet
+            return {}
+
+        now = time.monotonic()
+        window = self.limits.window if self.limits is not None else 10.0
+        samples = self.cpu_samples
+        samples.append((now, cpu_time))
+        while len(samples) > 2 and now - samples[1][0] >= window:
+            samples.popleft()
+        cpu = None
+        if now - samples[0][0] >= window:
+            cpu = (cpu_time - samples[0][1]) / (now - samples[0][0])
+
+        return dict(self.stats, pid=self.rpc.process.pid, rss=rss, cpu_time=cpu_time, cpu=cpu)
+
+    def on_output(self, stream, item):
+        if self.output is not None:
+            cell_id, text = item
+            self.output(cell_id, stream, text)
+
+    async def run(self, code, depends, exposes, cell_id=None, timeout=None, cpu_timeout=None):
+        interrupts = self.interrupts
+        async with self.run_lock:
+            if self.interrupts != interrupts:
+                raise CellInterrupted("The kernel was interrupted before the cell started")
+            generation = self.generation
+            running = self.rpc.do_run(code, set(depends), set(exposes), cell_id, timeout,
+                                      cpu_timeout)
+            if timeout is None:
+                return await running
+            try:
+                return await asyncio.wait_for(running, timeout + self.timeout_grace)
+            except asyncio.TimeoutError:
+                if self.generation == generation:
+                    self.restart()
+                raise KernelRestarted(
+                    "Cell didn't stop after its {}s timeout, the kernel was restarted".format(
+                        timeout))
+
+    async def get(self, varname, start=None, stop=None):
+        return await self.rpc.do_get(varname, start, stop)
+
+    def reset(self):
+        # sent right away, so it's done before any later command
+        self.rpc.notify('do_reset')
+        # the counters are the usage of the environment, not of the process
+        self.stats = dict.fromkeys(self.stats, 0)
+        self.cpu_samples.clear()
+
+    def preload(self, modules):
+        self.preloaded = list(modules)
+        self.rpc.notify('do_preload', self.preloaded)
+
+
+class KernelPool:
+    """
+    A pool of started kernels, so creating an environment doesn't have to wait for a new kernel
+    process to start and import its modules.
+    Released kernels are reset and reused, up to max_uses times each.
+    """
+    def __init__(self, size=4, max_uses=10, preload=(), factory=SubprocessKernel):
+        self.size = size
+        self.max_uses = max_uses
+        self.preload = list(preload)
+        self.factory = factory
+        self._idle = deque()
+        self._uses = {}
+        self.stats = dict(leased=0, cold_starts=0, reused=0, retired=0)
+
+    def _new_kernel(self):
+        kernel = self.factory()
+        self._uses[kernel] = 0
+        if self.preload:
+            kernel.preload(self.preload)
+        return kernel
+
+    def fill(self):
+        """Start kernels until the pool is full."""
+        while len(self._idle) < self.size:
+            self._idle.append(self._new_kernel())
+
+    def lease(self):
+        """Take a kernel from the pool (starting one if the pool is empty)."""
+        if self._idle:
+            kernel = self._idle.popleft()
+        else:
+            kernel = self._new_kernel()
+            self.stats['cold_starts'] += 1
+
+        self._uses[kernel] += 1
+        self.stats['leased'] += 1
+
+        # refill after the current work, so the lease itself doesn't wait for it
+        asyncio.get_event_loop().call_soon(self.fill)
+        return kernel
+
+    def release(self, kernel):
+        """
+        Give back a leased kernel, to be reset and reused (or killed if it's used up, or still
+        running commands that would end up in the next environment).
+        """
+        if self._uses[kernel] >= self.max_uses or kernel.busy():
+            self._retire(kernel)
+            asyncio.get_event_loop().call_soon(self.fill)
+            return
+
+        # reused kernels are leased first, the pool is kept at its size
+        kernel.set_output(None)
+        kernel.set_on_restart(None)
+        kernel.set_limits(None)
+        kernel.set_memo(0)
+        kernel.set_fingerprints(True)
+        kernel.reset()
+        self._idle.appendleft(kernel)
+        self.stats['reused'] += 1
+        while len(self._idle) > self.size:
+            self._retire(self._idle.pop())
+
+    def _retire(self, kernel):
+        del self._uses[kernel]
+        kernel.kill()
+        self.stats['retired'] += 1
+
+    def close(self):
+        """Kill the kernels that aren't leased."""
+        while self._idle:
+            self._retire(self._idle.popleft())
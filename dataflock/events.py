@@ -0,0 +1,80 @@
+import asyncio
+from collections import deque
+
+
+class Subscription:
+    """
+    The events of a Broadcaster for one subscriber, in a bounded queue.
+    When the subscriber doesn't keep up, new events are dropped (and counted) instead of queued.
+    """
+    def __init__(self, broadcaster, maxsize):
+        self.broadcaster = broadcaster
+        self.queue = asyncio.Queue(maxsize)
+        self.dropped = 0
+
+    def put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    async def get(self):
+        return await self.queue.get()
+
+    def close(self):
+        self.broadcaster.unsubscribe(self)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.get()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class Broadcaster:
+    """
+    Publishes events to subscribers without ever blocking the publisher.
+    The last maxlen events are kept in a ring buffer (for late subscribers), older ones are
+    dropped and counted.
+    """
+    def __init__(self, maxlen=1000, queue_size=100):
+        self.history = deque(maxlen=maxlen)
+        self.queue_size = queue_size
+        self.subscribers = set()
+        self.published = 0
+        self.dropped = 0
+
+    def publish(self, event):
+        if len(self.history) == self.history.maxlen:
+            self.dropped += 1
+        self.history.append(event)
+        self.published += 1
+        for subscription in self.subscribers:
+            subscription.put(event)
+
+    def subscribe(self, replay=False):
+        """Start receiving the events, the ones still in the history first if replay."""
+        subscription = Subscription(self, self.queue_size)
+        if replay:
+            for event in self.history:
+                subscription.put(event)
+        self.subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self.subscribers.discard(subscription)
+
+    def stats(self):
+        return dict(
+            published=self.published,
+            dropped=self.dropped,
+            buffered=len(self.history),
+            subscribers=len(self.subscribers),
+            subscribers_dropped=sum(s.dropped for s in self.subscribers),
+        )
@@ -1,8 +1,11 @@
 import uuid
 import asyncio
+import heapq
 from collections import defaultdict
 
+import analysis
 import engine
+import events
 
 """
 Missing API
@@ -12,11 +15,71 @@ DataFlock.document_get(environment, document_name)
 DataFlock.document_delete(environment, document_name)
 """
 
+
+class PullFailed(Exception):
+    """A cell needed to compute a pulled variable failed, was interrupted or deleted."""
+
+
+class EnvironmentClosed(PullFailed):
+    """The environment was deleted, its kernel may belong to another environment now."""
+
+
 class EnvironemntRunner:
     def set_dryrun(self):
-        self.dryrun = True
-
-    def __init__(self):
+        self._dryrun = True
+
+    def set_max_concurrency(self, max_concurrency):
+        """Limit how many cells can run at the same time (None for no limit)."""
+        self.max_concurrency = max_concurrency
+        self._dispatch_ready()
+
+    def set_coalesce(self, coalesce):
+        """
+        In coalescing mode, a new run of a running cell supersedes the running one: its results
+        are discarded, so the cells that depend on it only run with the latest values. The cell
+        runs again once the superseded run is over, however many times it was superseded.
+        """
+        self.coalesce = coalesce
+
+    def set_skip_unchanged(self, skip_unchanged):
+        """
+        Skip the cells whose inputs didn't change: when a cell produces the same values again (by
+        their fingerprints), the cells that depend on it are clean without running.
+        Without it, the kernel doesn't fingerprint the values (unless it has a memo).
+        """
+        self.skip_unchanged = skip_unchanged
+        self.kernel.set_fingerprints(skip_unchanged)
+
+    def set_memo(self, size):
+        """Let the kernel reuse the outputs of up to size runs of the same code on the same inputs."""
+        self.kernel.set_memo(size)
+
+    def set_timeouts(self, timeout=None, cpu_timeout=None):
+        """
+        Wall clock and CPU time limits (in seconds) for every cell of the environment, a cell
+        that runs longer fails. None for no limit.
+        """
+        self.timeout = timeout
+        self.cpu_timeout = cpu_timeout
+
+    def set_limits(self, limits):
+        """
+        Resource limits (an engine.ResourceLimits, or None) of the kernel, which is restarted when
+        it goes over them.
+        """
+        self.kernel.set_limits(limits)
+
+    def set_cell_timeouts(self, cell_id, timeout=None, cpu_timeout=None):
+        """Time limits for a cell, instead of the environment ones (None to use those)."""
+        self._cell_timeouts[cell_id] = (timeout, cpu_timeout)
+
+    def cell_timeouts(self, cell_id):
+        timeout, cpu_timeout = self._cell_timeouts.get(cell_id, (None, None))
+        return (timeout if timeout is not None else self.timeout,
+                cpu_timeout if cpu_timeout is not None else self.cpu_timeout)
+
+    def __init__(self, max_concurrency=None, coalesce=False, kernel=None,
+                 timeout=None, cpu_timeout=None, skip_unchanged=True):
         self.cells = {}
         self._exposes = {}
         self._depends = defaultdict(set)
@@ -24,8 +87,52 @@ class EnvironemntRunner:
         self._dirty = set()
         self._live = {}
         self._dryrun = False
-        self._callback = lambda *args: None
-        self.kernel = engine.KernelProxy()
+        self._listener = lambda *args: None
+        self._closed = False
+        # the scheduling events ("dirtied", "running", "finished"...) as {"id", "event", "args"}
+        self.events = events.Broadcaster()
+        self.kernel = kernel if kernel is not None else engine.KernelProxy()
+        # what the cells print, as {"cell", "stream", "text"} events
+        self.output = events.Broadcaster()
+        self.kernel.set_output(self.on_cell_output)
+        self.kernel.set_on_restart(self.on_kernel_restarted)
+        self.kernel.set_fingerprints(skip_unchanged)
+
+        # scheduler state
+        self.max_concurrency = max_concurrency
+        self._requested = set()  # cells asked to run even if they aren't live
+        self._rerun = set()  # running cells that were dirtied again, so they must run again
+        self._ready = []  # heap of (topological rank, cell id) waiting for a free slot
+        self._queued = set()
+        self.coalesce = coalesce
+        self._generation = defaultdict(int)  # current run of each cell, older runs are discarded
+        self._tasks = {}
+        self._interrupted = set()  # running cells whose dependents must not run
+        self._stale = set()  # non-live cells whose current code never ran
+        self._waiters = defaultdict(list)  # cell id -> futures waiting for it to be clean
+        self.skip_unchanged = skip_unchanged
+        self._fingerprints = {}  # cell id -> fingerprints of the values of its last run
+        self._must_run = set()  # dirty cells whose code or inputs changed
+        self._versions = {}  # variable -> version, bumped every time its value changes
+        self._version_waiters = defaultdict(list)  # variable -> futures waiting for a new version
+        self.timeout = timeout
+        self.cpu_timeout = cpu_timeout
+        self._cell_timeouts = {}
+        # topological order of the cells (cell id -> position), kept incrementally
+        self._order = {}
+        self._next_order = 0
+        self.stats = dict(
+            queue_depth=0,
+            max_queue_depth=0,
+            critical_path=0,
+            executed=0,
+            failed=0,
+            interrupted=0,
+            skipped=0,
+            memoized=0,
+            coalesced=0,
+            discarded=0,
+        )
 
     def get_cells(self):
         return list(self.cells.keys())
@@ -33,14 +140,13 @@ class EnvironemntRunner:
     def cell_create(self, cell, live=True):
 
         # check duplicate exposure
-        duplicate_names = set(cell.exposes).intersection(set(self._exposes.keys()))
+        duplicate_names = set(name for name in cell.exposes if name in self._exposes)
         if duplicate_names:
             raise NameError("Tried to re-define previously exposed variables: %s" % (duplicate_names,))
 
-        self.raise_if_loop(cell)
-
         # create cell
         cid = str(uuid.uuid4())
+        self.raise_if_loop(cell, cid)
         self.cells[cid] = cell
         self.link_cell(cid, cell, live)
         
@@ -48,18 +154,192 @@ class EnvironemntRunner:
         
         if live:
             self.cell_run(cid)
+        else:
+            self._stale.add(cid)
         return cid
 
-    def raise_if_loop(self, cell):
-        # check definition loop
-        start = set()
-        for var in cell.exposes:
-            start.update(self.depends(var))
+    def cells_create(self, cells, live=True):
+        """
+        Create many cells at once: they are linked in a single pass, checked for loops once and
+        scheduled together. Either all the cells are created, or none.
+        """
+        # check duplicate exposure, against the existing cells and between the new ones
+        exposed = set(self._exposes.keys())
+        for cell in cells:
+            duplicate_names = exposed.intersection(cell.exposes)
+            if duplicate_names:
+                raise NameError("Tried to re-define previously exposed variables: %s" % (duplicate_names,))
+            exposed.update(cell.exposes)
+
+        # create cells
+        cids = [str(uuid.uuid4()) for _ in cells]
+        for cid, cell in zip(cids, cells):
+            self.cells[cid] = cell
+            self.link_cell(cid, cell, live)
+
+        try:
+            self.raise_if_loops(cids)
+        except ValueError:
+            for cid, cell in zip(cids, cells):
+                del self.cells[cid]
+                self.unlink_cell(cid, cell)
+            raise
+
+        for cid, cell in zip(cids, cells):
+            self._callback("created:", cid, live, cell.code)
 
-        for c in start:
-            for n in self.walk(c):
-                if self.cells[n].exposes.intersection(cell.depends):
+        if live:
+            self.cells_run(cids)
+        else:
+            self._stale.update(cids)
+        return cids
+
+    def cells_import(self, codes, live=True, max_workers=None):
+        """
+        Bulk import of cells (eg. a whole notebook): the code is analyzed in a pool of processes,
+        then the cells are created at once.
+        """
+        return self.cells_create(analysis.analyze_cells(codes, max_workers=max_workers), live)
+
+    async def cells_import_async(self, codes, live=True, max_workers=None):
+        """Like cells_import, without blocking the event loop while the code is analyzed."""
+        cells = await analysis.analyze_cells_async(codes, max_workers=max_workers)
+        return self.cells_create(cells, live)
+
+    def raise_if_loops(self, cell_ids):
+        """
+        Check for loops around already linked cells, with a single topological sort of the cells
+        that depend on them. Those cells are moved to the end of the topological order.
+        """
+        order, _ = self.topological_order(self.reachable(cell_ids))
+
+        for cid in order:
+            self._order[cid] = self._next_order
+            self._next_order += 1
+
+    def topological_order(self, cell_ids):
+        """
+        Sort a set of cells so every cell comes after the cells it depends on.
+        Returns the sorted cells and the length of the longest dependency chain among them.
+        """
+        pending_parents = dict(
+            (cid, len(self.parent_cells(cid) & cell_ids)) for cid in cell_ids)
+        ready = [cid for cid, count in pending_parents.items() if count == 0]
+        order = []
+
+        while ready:
+            cid = ready.pop()
+            order.append(cid)
+            for child in self.dependent_cells(cid):
+                if child not in pending_parents:
+                    continue
+                pending_parents[child] -= 1
+                if pending_parents[child] == 0:
+                    ready.append(child)
+
+        if len(order) != len(cell_ids):
+            raise ValueError("Loop")
+
+        return order, self.critical_path(order)
+
+    def critical_path(self, order):
+        """Length of the longest dependency chain among topologically sorted cells."""
+        depth = dict((cid, 1) for cid in order)
+
+        for cid in order:
+            for child in self.dependent_cells(cid):
+                if child in depth:
+                    depth[child] = max(depth[child], depth[cid] + 1)
+
+        return max(depth.values(), default=0)
+
+    def raise_if_loop(self, cell, cell_id):
+        """
+        Check that linking the (not linked) cell doesn't create a definition loop, keeping the
+        topological order of the cells up to date.
+        Each new dependency is added with the Pearce-Kelly algorithm: only the cells between the
+        two ends of the dependency in the current order are visited (and reordered if needed).
+        If there's a loop, the order is left as it was.
+        """
+        if cell.exposes & cell.depends:
+            raise ValueError("Loop")
+
+        parents = set(self._exposes[v] for v in cell.depends if v in self._exposes)
+        children = set()
+        for v in cell.exposes:
+            children.update(self._depends.get(v, ()))
+
+        is_new = cell_id not in self._order
+        if is_new:
+            self._order[cell_id] = self._next_order
+            self._next_order += 1
+
+        # the dependencies of the cell added so far (the cell itself isn't linked yet)
+        added_children = defaultdict(set)
+        added_parents = defaultdict(set)
+
+        def successors(cid):
+            if cid == cell_id:
+                return added_children[cid]
+            return self.dependent_cells(cid) | added_children[cid]
+
+        def predecessors(cid):
+            if cid == cell_id:
+                return added_parents[cid]
+            return self.parent_cells(cid) | added_parents[cid]
+
+        previous_order = {}
+        try:
+            for source, target in ([(parent, cell_id) for parent in parents] +
+                                   [(cell_id, child) for child in children]):
+                self._add_dependency(source, target, successors, predecessors, previous_order)
+                added_children[source].add(target)
+                added_parents[target].add(source)
+        except ValueError:
+            self._order.update(previous_order)
+            if is_new:
+                del self._order[cell_id]
+            raise
+
+    def _add_dependency(self, source, target, successors, predecessors, previous_order):
+        """
+        Pearce-Kelly insertion of the source -> target dependency in the topological order.
+        The replaced positions are saved in previous_order.
+        """
+        order = self._order
+        lower, upper = order[target], order[source]
+        if lower > upper:
+            # already in order
+            return
+
+        # cells after target and before source that target leads to
+        forward = set()
+        stack = [target]
+        while stack:
+            cid = stack.pop()
+            forward.add(cid)
+            for child in successors(cid):
+                if child == source:
                     raise ValueError("Loop")
+                if child not in forward and order[child] < upper:
+                    stack.append(child)
+
+        # cells after target and before source that lead to source
+        backward = set()
+        stack = [source]
+        while stack:
+            cid = stack.pop()
+            backward.add(cid)
+            for parent in predecessors(cid):
+                if parent not in backward and order[parent] > lower:
+                    stack.append(parent)
+
+        # reuse the same positions, putting the backward cells before the forward ones
+        affected = sorted(backward, key=order.get) + sorted(forward, key=order.get)
+        positions = sorted(order[cid] for cid in affected)
+        for cid, position in zip(affected, positions):
+            previous_order.setdefault(cid, order[cid])
+            order[cid] = position
 
     def link_cell(self, cell_id, cell, live):
         for varname in cell.exposes:
@@ -78,14 +358,45 @@ class EnvironemntRunner:
     def walk(self, cell_id):
         """Iterate over depending nodes in depth-first."""
 
-        stack = {cell_id}
-        
+        stack = [cell_id]
+        seen = {cell_id}
+
         while stack:
             current = stack.pop()
-            children = self.dependent_cells(current)
+            children = self.dependent_cells(current) - seen
             yield current
-            stack.update(children)
-        
+            seen.update(children)
+            stack.extend(children)
+
+
+    def reachable(self, cell_ids):
+        """Return the set of the cells and all the cells that depend on them, directly or not."""
+        seen = set(cell_ids)
+        stack = list(seen)
+
+        while stack:
+            for child in self.dependent_cells(stack.pop()):
+                if child not in seen:
+                    seen.add(child)
+                    stack.append(child)
+        return seen
+
+    def upstream(self, cell_ids):
+        """Return the set of the cells and all the cells they depend on, directly or not."""
+        seen = set(cell_ids)
+        stack = list(seen)
+
+        while stack:
+            for parent in self.parent_cells(stack.pop()):
+                if parent not in seen:
+                    seen.add(parent)
+                    stack.append(parent)
+        return seen
+
+    def parent_cells(self, cid):
+        """Return a set of all the cells that expose variables this cell depends on."""
+        return set(self._exposes[v] for v in self.cells[cid].depends if v in self._exposes)
+
     def dependent_cells(self, cid):
         """Return a set of all the cells that depend on variables defined in this cell."""
         deps = set()
@@ -97,59 +408,392 @@ class EnvironemntRunner:
         cell = self.cells[cell_id]
         del self.cells[cell_id]
         self.unlink_cell(cell_id, cell)
+        self._dirty.discard(cell_id)
+        self._requested.discard(cell_id)
+        self._rerun.discard(cell_id)
+        self._stale.discard(cell_id)
+        self._must_run.discard(cell_id)
+        self._fingerprints.pop(cell_id, None)
+        self._cell_timeouts.pop(cell_id, None)
+        del self._order[cell_id]
+        self._fail_waiters([cell_id], "deleted")
+
+        # its run (if any) is abandoned, the slot can be used by another cell
+        task = self._tasks.pop(cell_id, None)
+        if task is not None:
+            task.cancel()
+        if cell_id in self._running:
+            self._running.remove(cell_id)
+            self._interrupted.discard(cell_id)
+            self._dispatch_ready()
         
     def cell_get(self, cell_id):
         return self.cells[cell_id]
 
     def cell_update(self, cell_id, cell, live=True):
-        self.raise_if_loop(cell)
-
-        if cell_id in self.cells:
-            self.unlink_cell(cell_id, self.cells[cell_id])
-        self.cells[cell_id] = cell
-        self.link_cell(cell_id, cell, live)
+        previous = self.cells.get(cell_id)
+
+        if previous is not None and cell.same_interface(previous):
+            # the dependency graph doesn't change, no need to check for loops or relink
+            self.cells[cell_id] = cell
+            self._live[cell_id] = live
+        else:
+            if previous is not None:
+                previous_live = self._live[cell_id]
+                self.unlink_cell(cell_id, previous)
+
+            try:
+                self.raise_if_loop(cell, cell_id)
+            except ValueError:
+                if previous is not None:
+                    self.link_cell(cell_id, previous, previous_live)
+                raise
+
+            self.cells[cell_id] = cell
+            self.link_cell(cell_id, cell, live)
         self._callback("updated:", cell_id, live, cell.code)
         if live:
             self.cell_run(cell_id)
+        else:
+            self._stale.add(cell_id)
+
+    def cells_update(self, cells, live=True):
+        """
+        Update many cells at once, given as (cell_id, cell) pairs; a None cell_id creates the
+        cell. They are relinked in a single pass, checked for loops once and scheduled together.
+        Either all the cells are updated, or none. Returns the ids of the cells.
+        """
+        cids = [str(uuid.uuid4()) if cid is None else cid for cid, _ in cells]
+        if len(set(cids)) != len(cids):
+            raise ValueError("The same cell is updated more than once")
+        previous = dict((cid, (self.cells[cid], self._live[cid])) for cid in cids if cid in self.cells)
+
+        # the cells are unlinked first, so they can move variables between them
+        for cid, (cell, _) in previous.items():
+            self.unlink_cell(cid, cell)
+
+        linked = []
+
+        def restore():
+            for cid in linked:
+                self.unlink_cell(cid, self.cells.pop(cid))
+            for cid, (cell, cell_live) in previous.items():
+                self.cells[cid] = cell
+                self.link_cell(cid, cell, cell_live)
+
+        # check duplicate exposure, against the other cells and between the updated ones
+        exposed = set(self._exposes.keys())
+        for _, cell in cells:
+            duplicate_names = exposed.intersection(cell.exposes)
+            if duplicate_names:
+                restore()
+                raise NameError("Tried to re-define previously exposed variables: %s" % (duplicate_names,))
+            exposed.update(cell.exposes)
+
+        for cid, (_, cell) in zip(cids, cells):
+            self.cells[cid] = cell
+            self.link_cell(cid, cell, live)
+            linked.append(cid)
+
+        try:
+            self.raise_if_loops(cids)
+        except ValueError:
+            restore()
+            raise
+
+        for cid, (_, cell) in zip(cids, cells):
+            if cid in previous:
+                self._callback("updated:", cid, live, cell.code)
+            else:
+                self._callback("created:", cid, live, cell.code)
 
-    async def __cell_run(self, cell_id): 
-        cell = self.cells[cell_id]
-        await self.kernel.run(cell.code, cell.depends, cell.exposes)
-        self.on_cell_run_finished(cell_id)
+        if live:
+            self.cells_run(cids)
+        else:
+            self._stale.update(cids)
+        return cids
+
+    async def __cell_run(self, cell_id, cell, generation):
+        timeout, cpu_timeout = self.cell_timeouts(cell_id)
+        try:
+            info = await self.kernel.run(cell.code, cell.depends, cell.exposes, cell_id,
+                                         timeout, cpu_timeout)
+        except engine.KernelRestarted as e:
+            self.on_kernel_restarted("timeout")
+            self.on_cell_run_failed(cell_id, e, generation)
+        except Exception as e:
+            self.on_cell_run_failed(cell_id, e, generation)
+        else:
+            self.on_cell_run_finished(cell_id, generation, info)
 
     def _cell_run(self, cell_id):
-        if not self._dryrun:
+        if not self._dryrun and not self._closed:
             loop = asyncio.get_event_loop()
-            loop.create_task(self.__cell_run(cell_id))
+            self._tasks[cell_id] = loop.create_task(
+                self.__cell_run(cell_id, self.cells[cell_id], self._generation[cell_id]))
+
+    def _supersede(self, cell_id):
+        """
+        Discard the results of the current run of the cell. The kernel still runs it, so the
+        cell stays running until it's over and then runs again (starting another run right
+        away would only pile up runs in the kernel).
+        """
+        self._generation[cell_id] += 1
+        self._must_run.add(cell_id)
+        self.stats['coalesced'] += 1
+
+    def _is_current(self, cell_id, generation):
+        if generation is None or generation == self._generation[cell_id]:
+            self._tasks.pop(cell_id, None)
+            return True
+
+        # results from a superseded run: now the latest one can start
+        self.stats['discarded'] += 1
+        self._tasks.pop(cell_id, None)
+        self._running.discard(cell_id)
+        self._interrupted.discard(cell_id)
+        if cell_id in self.cells:
+            self._enqueue_if_ready(cell_id)
+        self._dispatch_ready()
+        return False
 
     def cell_run(self, cell_id):
-        self._callback("running", cell_id, self._live[cell_id])
-        self._cell_run(cell_id)
-
-        self._running.add(cell_id)
-        for cid in self.walk(cell_id):
+        self.cells_run([cell_id])
+
+    def cells_run(self, cell_ids):
+        """
+        Run cells, and then every cell that depends on them.
+        The dirty subgraph is computed and sorted once; from then on cells are dispatched as soon
+        as all their parents finished, so every cell runs once per invalidation.
+        """
+        dirty = self.reachable(cell_ids)
+        order = sorted(dirty, key=self._order.get)
+        self.stats['critical_path'] = self.critical_path(order)
+
+        for cid in order:
             self._callback("dirtied:", cid)
-            self._dirty.add(cid)    
-
-    def on_cell_run_finished(self, cell_id):
+            self._dirty.add(cid)
+            if cid in self._running:
+                if self.coalesce:
+                    self._supersede(cid)
+                else:
+                    self._rerun.add(cid)
+            elif cid in self._queued and self.coalesce:
+                # it will run once, with the latest values
+                self.stats['coalesced'] += 1
+
+        self._requested.update(cell_ids)
+        self._must_run.update(cell_ids)
+
+        # the cells with dirty parents will run when their parents finish
+        for cid in cell_ids:
+            self._enqueue_if_ready(cid)
+        self._dispatch_ready()
+
+    def _is_ready(self, cell_id):
+        """A dirty cell can run when it isn't running already and none of its parents is dirty."""
+        return (cell_id in self._dirty and
+                cell_id not in self._running and
+                cell_id not in self._queued and
+                (self._live[cell_id] or cell_id in self._requested) and
+                not any(self.is_dirty(parent) for parent in self.parent_cells(cell_id)))
+
+    def _enqueue_if_ready(self, cell_id):
+        if self._is_ready(cell_id):
+            heapq.heappush(self._ready, (self._order[cell_id], cell_id))
+            self._queued.add(cell_id)
+
+    def _dispatch_ready(self):
+        """Start ready cells, in topological order, while there are free slots."""
+        if self._closed:
+            return
+        while self._ready and (self.max_concurrency is None or
+                               len(self._running) < self.max_concurrency):
+            _, cid = heapq.heappop(self._ready)
+            self._queued.discard(cid)
+            if cid not in self.cells or not self._is_ready(cid):
+                # deleted, or dirtied again while queued: it's queued again when ready
+                continue
+
+            self._requested.discard(cid)
+            # stale cells never ran their current code, whatever their inputs
+            if self.skip_unchanged and cid not in self._must_run and cid not in self._stale:
+                self._skip(cid)
+                continue
+            self._must_run.discard(cid)
+            self._running.add(cid)
+            self.stats['executed'] += 1
+            self._callback("running", cid, self._live[cid])
+            self._cell_run(cid)
+
+        self.stats['queue_depth'] = len(self._ready)
+        self.stats['max_queue_depth'] = max(self.stats['max_queue_depth'], len(self._ready))
+
+    def on_cell_run_finished(self, cell_id, generation=None, info=None):
+        """info is what the kernel returned, with the fingerprints of the exposed values."""
+        if not self._is_current(cell_id, generation):
+            return
         self._running.remove(cell_id)
+        # finished before the interrupt got to it: the rest of the run is still cancelled
+        interrupted = cell_id in self._interrupted
+        self._interrupted.discard(cell_id)
+
+        if cell_id not in self.cells:
+            # deleted while running
+            self._dispatch_ready()
+            return
+
+        self._record_run(cell_id, info)
+        if cell_id in self._rerun:
+            # dirtied again while running: it must run again before its dependents can
+            self._rerun.remove(cell_id)
+            if not interrupted:
+                self._enqueue_if_ready(cell_id)
+            self._dispatch_ready()
+            return
+
         self._dirty.remove(cell_id)
+        self._stale.discard(cell_id)
         self._callback("finished:", cell_id)
+        for waiter in self._waiters.pop(cell_id, ()):
+            if not waiter.done():
+                waiter.set_result(None)
 
         # notify on new variables
         for varname in self.cells[cell_id].exposes:
             self._callback("updated", varname)
-        # get cells that could run
-        targets = self.dependent_cells(cell_id)
-        
-        # filter out cells with dirty parents
-        for target in targets:
-            for v in self.cells[target].depends:
-                if self.is_dirty(self.exposes(v)):
-                    break
-            else:
-                if self._live[target]:
-                    self.cell_run(target)
+
+        # run the dependent cells that have no other dirty parent
+        if not interrupted:
+            for target in self.dependent_cells(cell_id):
+                self._enqueue_if_ready(target)
+        self._dispatch_ready()
+
+    def _record_run(self, cell_id, info):
+        """Keep the fingerprints of the run, the dependents must run if they changed."""
+        fingerprints = info.get('fingerprints') if info else None
+        previous = self._fingerprints.get(cell_id)
+        if info and info.get('memoized'):
+            self.stats['memoized'] += 1
+
+        for varname in self.cells[cell_id].exposes:
+            fingerprint = fingerprints.get(varname) if fingerprints is not None else None
+            if fingerprint is None or fingerprint != (previous or {}).get(varname):
+                self._bump_version(varname)
+
+        if fingerprints is None:
+            self._fingerprints.pop(cell_id, None)
+        else:
+            self._fingerprints[cell_id] = fingerprints
+        if (fingerprints is None or fingerprints != previous or
+                any(value is None for value in fingerprints.values())):
+            self._must_run.update(self.dependent_cells(cell_id))
+
+    def _bump_version(self, varname):
+        self._versions[varname] = self._versions.get(varname, 0) + 1
+        for waiter in self._version_waiters.pop(varname, ()):
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def version(self, varname):
+        """
+        The version of the value of a variable: it only increases, each time a run changes the
+        value (0 until it's computed).
+        """
+        return self._versions.get(varname, 0)
+
+    async def wait_version(self, varname, version, timeout=None):
+        """
+        Wait until the version of the variable is greater than version, for at most timeout
+        seconds. Returns the current version.
+        """
+        if self.version(varname) <= version:
+            waiter = asyncio.get_event_loop().create_future()
+            self._version_waiters[varname].append(waiter)
+            try:
+                await asyncio.wait_for(waiter, timeout)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                if waiter in self._version_waiters.get(varname, ()):
+                    self._version_waiters[varname].remove(waiter)
+        return self.version(varname)
+
+    def _skip(self, cell_id):
+        """The inputs of the cell didn't change, its values are still valid."""
+        self._dirty.remove(cell_id)
+        self.stats['skipped'] += 1
+        self._callback("skipped:", cell_id)
+        for waiter in self._waiters.pop(cell_id, ()):
+            if not waiter.done():
+                waiter.set_result(None)
+        for target in self.dependent_cells(cell_id):
+            self._enqueue_if_ready(target)
+
+    def on_cell_run_failed(self, cell_id, error, generation=None):
+        """The cell stays dirty, and so do the cells that depend on it."""
+        if not self._is_current(cell_id, generation):
+            return
+        self._running.remove(cell_id)
+        self._rerun.discard(cell_id)
+        self._interrupted.discard(cell_id)
+        # it has no valid values, it must run again even if its inputs don't change
+        self._must_run.add(cell_id)
+        self.stats['failed'] += 1
+        self._callback("failed:", cell_id, repr(error))
+        if self._waiters:
+            self._fail_waiters(self.reachable([cell_id]), "failed: {!r}".format(error), cell_id)
+        self._dispatch_ready()
+
+    def _fail_waiters(self, cell_ids, reason, cause=None):
+        for cid in cell_ids:
+            for waiter in self._waiters.pop(cid, ()):
+                if not waiter.done():
+                    waiter.set_exception(PullFailed("Cell {} {}".format(cause or cid, reason)))
+
+    def cells_pull(self, cell_ids):
+        """
+        Run the dirty and stale cells the given cells need (themselves included), and nothing
+        more than that, except for the live cells that were waiting for them.
+        Return the cells that will run.
+        """
+        needed = self.upstream(cell_ids)
+        stale = [cid for cid in needed if cid in self._stale and cid not in self._dirty]
+        if stale:
+            # dirties everything that depends on them, the needed cells are requested below
+            self.cells_run(stale)
+
+        pulled = [cid for cid in needed if cid in self._dirty and
+                  (cid not in self._running or cid in self._rerun)]
+        self._requested.update(pulled)
+        for cid in sorted(pulled, key=self._order.get):
+            self._enqueue_if_ready(cid)
+        self._dispatch_ready()
+        return set(pulled) | (needed & self._running)
+
+    def needs_pull(self, cell_id):
+        return any(cid in self._dirty or cid in self._stale for cid in self.upstream([cell_id]))
+
+    async def pull(self, cell_id):
+        """Run what's needed to compute the cell, and wait for it to finish."""
+        await self.pull_cells([cell_id])
+
+    async def pull_cells(self, cell_ids):
+        """Run what's needed to compute the cells, in a single pass, and wait for them to finish."""
+        self._raise_if_closed()
+        self.cells_pull(cell_ids)
+        waiters = []
+        for cid in cell_ids:
+            if cid in self._dirty:
+                waiter = asyncio.get_event_loop().create_future()
+                self._waiters[cid].append(waiter)
+                waiters.append(waiter)
+        for result in await asyncio.gather(*waiters, return_exceptions=True):
+            if isinstance(result, BaseException):
+                raise result
+
+    def on_cell_output(self, cell_id, stream, text):
+        self.output.publish(dict(cell=cell_id, stream=stream, text=text))
 
     def is_dirty(self, cell_id):
         return cell_id in self._dirty
@@ -166,15 +810,104 @@ class EnvironemntRunner:
         return self._depends[varname]
 
     def set_callback(self, callback):
-        self._callback = callback
-
-    def get_variable(self, varname):
-        return self.kernel.get(varname)
+        self._listener = callback
+
+    def _callback(self, name, *args):
+        self.events.publish(dict(id=self.events.published, event=name.rstrip(":"), args=list(args)))
+        self._listener(name, *args)
+
+    async def get_variable(self, varname, pull=True, start=None, stop=None):
+        """
+        Get the value of a variable, or its [start:stop] slice. With pull, if the cell exposing
+        it (or one of the cells it depends on) is dirty or never ran, they are run first.
+        """
+        if pull:
+            await self.pull_variable(varname)
+        self._raise_if_closed()
+        return await self.kernel.get(varname, start, stop)
+
+    async def pull_variable(self, varname):
+        """Run the cells the variable needs, if it's dirty or never ran."""
+        cell_id = self._exposes.get(varname)
+        if cell_id is not None and not self._dryrun and self.needs_pull(cell_id):
+            await self.pull(cell_id)
+
+    async def get_variables(self, varnames, pull=True):
+        """
+        Get the values of many variables, as a dict. The cells they need are pulled together,
+        and the values are asked to the kernel at once.
+        """
+        if pull and not self._dryrun:
+            cell_ids = set(self._exposes[v] for v in varnames if v in self._exposes)
+            await self.pull_cells([cid for cid in cell_ids if self.needs_pull(cid)])
+        self._raise_if_closed()
+        values = await asyncio.gather(*[self.kernel.get(varname) for varname in varnames])
+        return dict(zip(varnames, values))
+
+    def on_kernel_restarted(self, reason=None):
+        """
+        The kernel lost its variables: every cell is dirty. The live cells that were clean run
+        again, the cells that were dirty already (eg. the one that broke the kernel) stay as they
+        were, until they are run again.
+        """
+        lost = [cid for cid in self.cells if cid not in self._dirty]
+        self._dirty.update(self.cells)
+        self._must_run.update(self.cells)
+        self._fingerprints.clear()
+        self._callback("restarted", reason)
+        for cid in sorted(lost, key=self._order.get):
+            self._enqueue_if_ready(cid)
+        self._dispatch_ready()
+
+    def usage(self):
+        """Resource usage of the environment's kernel."""
+        return dict(self.kernel.usage(), cells=len(self.cells), running=len(self._running))
+
+    def interrupt(self):
+        """
+        Interrupt the running cells, and cancel the rest of the run: the cells waiting for them
+        stay dirty until they are run again.
+        """
+        cancelled = (self._queued | self._requested) - self._running
+        self._ready = []
+        self._queued.clear()
+        self._requested.clear()
+        self._interrupted.update(self._running)
+        self._fail_waiters(list(self._waiters), "interrupted")
+        self.stats['queue_depth'] = 0
+        self.stats['interrupted'] += len(self._running) + len(cancelled)
+        self._callback("interrupted", sorted(self._running | cancelled))
+        self.kernel.interrupt()
+
+
+    def close(self):
+        """
+        Stop for good: the runs that didn't start yet are cancelled and nothing else is sent to
+        the kernel, so it can be given to another environment.
+        """
+        self._closed = True
+        self._ready = []
+        self._queued.clear()
+        self._requested.clear()
+        for task in self._tasks.values():
+            task.cancel()
+        self._tasks.clear()
+        self.stats['queue_depth'] = 0
+        for cid in list(self._waiters):
+            for waiter in self._waiters.pop(cid):
+                if not waiter.done():
+                    waiter.set_exception(EnvironmentClosed("The environment was deleted"))
+
+    def _raise_if_closed(self):
+        if self._closed:
+            raise EnvironmentClosed("The environment was deleted")
 
 
 class DataFlock:
-    def __init__(self):
+    def __init__(self, kernel_factory=engine.KernelProxy, kernel_pool=None):
         self.environments = {}
+        self.kernel_factory = kernel_factory
+        self.kernel_pool = kernel_pool
 
     def list_environments(self):
         return list(self.environments.keys())
@@ -186,10 +919,25 @@ class DataFlock:
         if name in self.environments:
             raise KeyError("Environment already exists")
 
-        er = EnvironemntRunner()
+        if self.kernel_pool is not None:
+            kernel = self.kernel_pool.lease()
+        else:
+            kernel = self.kernel_factory()
+
+        er = EnvironemntRunner(kernel=kernel)
         self.environments[name] = er
         return er
 
     def environemnt_delete(self, name):
-        del self.environments[name]
+        er = self.environments.pop(name)
+        er.close()
+        if self.kernel_pool is not None:
+            self.kernel_pool.release(er.kernel)
+        else:
+            er.kernel.kill()
+
+    def close(self):
+        """Delete every environment, so none of their kernels outlives the flock."""
+        for name in self.list_environments():
+            self.environemnt_delete(name)
 
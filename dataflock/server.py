@@ -1,8 +1,13 @@
 from aiohttp import web
+import asyncio
 import json
+import os
 
 import runner
 import analysis
+import encoding
+import engine
+import subrpc
 
 def jsonresponse(func):
     async def inner(*args, **kwargs):
@@ -10,8 +15,81 @@ def jsonresponse(func):
         return web.Response(text=json.dumps(result))
     return inner
 
-def build_app():
-    df = runner.DataFlock()
+# a comment line is sent on idle event streams after this many seconds, so proxies keep them open
+KEEPALIVE_INTERVAL = 15
+# how long (at most) a request waits for a new version of a variable, in seconds
+LONG_POLL_TIMEOUT = 30
+LONG_POLL_MAX_TIMEOUT = 300
+
+
+def negotiate(request):
+    """The (content type, encoder) to answer the request with, or HTTPNotAcceptable."""
+    negotiated = encoding.negotiate(request.headers.get('Accept'))
+    if negotiated is None:
+        raise web.HTTPNotAcceptable(text="the value can be sent as: {}".format(
+            ", ".join(media_type for media_type, _ in encoding.formats())))
+    return negotiated
+
+
+async def stream_value(request, value, negotiated, headers=None):
+    content_type, encode = negotiated
+    # the first chunk is encoded before answering, so values that can't be encoded in this
+    # format are still an error instead of a truncated response
+    chunks = encode(value)
+    try:
+        first = next(chunks, b"")
+    except (TypeError, ValueError) as e:
+        raise web.HTTPNotAcceptable(text=str(e))
+
+    response = web.StreamResponse(headers=dict(headers or {}, **{'Content-Type': content_type}))
+    response.enable_chunked_encoding()
+    await response.prepare(request)
+    await response.write(first)
+    for chunk in chunks:
+        await response.write(chunk)
+    await response.write_eof()
+    return response
+
+
+def subscribe(env, request):
+    """Subscribe to the scheduling events of the environment, or to the cells output."""
+    broadcaster = env.output if request.query.get('stream') == 'output' else env.events
+    return broadcaster.subscribe(replay=request.query.get('replay') in ('1', 'true'))
+
+
+async def forward_events(subscription, send, keepalive):
+    """
+    Send the events to a client, as fast as it takes them: events that don't fit in its buffer
+    meanwhile are dropped, and the client is told how many.
+    """
+    dropped = 0
+    while True:
+        try:
+            event = await asyncio.wait_for(subscription.get(), KEEPALIVE_INTERVAL)
+        except asyncio.TimeoutError:
+            await keepalive()
+            continue
+        if subscription.dropped != dropped:
+            await send(dict(event="dropped", args=[subscription.dropped - dropped]))
+            dropped = subscription.dropped
+        await send(event)
+
+
+def build_app(analysis_cache_path=None, kernel_factory=engine.SubprocessKernel,
+              kernel_pool_size=0, kernel_max_uses=10, kernel_preload=(), kernel_limits=None):
+    kernel_pool = None
+    if kernel_pool_size:
+        kernel_pool = engine.KernelPool(
+            size=kernel_pool_size,
+            max_uses=kernel_max_uses,
+            preload=kernel_preload,
+            factory=kernel_factory,
+        )
+    df = runner.DataFlock(kernel_factory=kernel_factory, kernel_pool=kernel_pool)
+
+    if analysis_cache_path:
+        analysis.cache.path = analysis_cache_path
+        analysis.cache.load()
 
     def logger(*args, **kwargs):
         print(*(list(args) + [kwargs]))
@@ -40,6 +118,9 @@ def build_app():
             raise web.HTTPBadRequest(text=str(e))
 
         env.set_callback(logger)
+        env.set_timeouts(data.get('timeout'), data.get('cpu_timeout'))
+        if kernel_limits is not None:
+            env.set_limits(kernel_limits)
 
         return data['name']
 
@@ -54,9 +135,11 @@ def build_app():
         env = get_env(request)
         
         try:
-            cell_id = env.cell_create(analysis.Cell(code))
-        except NameError as e:
+            cell_id = env.cell_create(analysis.Cell(code, cache=analysis.cache))
+        except (NameError, ValueError) as e:
             raise web.HTTPBadRequest(text=str(e))
+        if 'timeout' in data or 'cpu_timeout' in data:
+            env.set_cell_timeouts(cell_id, data.get('timeout'), data.get('cpu_timeout'))
 
         return cell_id
 
@@ -69,39 +152,229 @@ def build_app():
         code = data['code']
 
         env = get_env(request)
-        
+        cell_id = request.match_info['cell_id']
+
+        try:
+            previous = env.cell_get(cell_id)
+        except KeyError:
+            cell = analysis.Cell(code, cache=analysis.cache)
+        else:
+            # only re-analyze the statements that changed
+            cell = analysis.Cell(code, previous=previous)
+
+        if 'timeout' in data or 'cpu_timeout' in data:
+            env.set_cell_timeouts(cell_id, data.get('timeout'), data.get('cpu_timeout'))
         try:
-            env.cell_update(
-                request.match_info['cell_id'],
-                analysis.Cell(code)
-            )
-        except NameError as e:
+            env.cell_update(cell_id, cell)
+        except (NameError, ValueError) as e:
             raise web.HTTPBadRequest(text=str(e))
 
         return
 
+    async def stream_events(request):
+        """Server-sent events of the environment."""
+        env = get_env(request)
+        response = web.StreamResponse(headers={
+            'Content-Type': 'text/event-stream',
+            'Cache-Control': 'no-cache',
+        })
+        await response.prepare(request)
+
+        async def send(event):
+            lines = []
+            if 'id' in event:
+                lines.append("id: {}".format(event['id']))
+            lines.append("event: {}".format(event.get('event', 'output')))
+            lines.append("data: {}".format(json.dumps(event)))
+            await response.write(("\n".join(lines) + "\n\n").encode())
+
+        async def keepalive():
+            await response.write(b": keepalive\n\n")
+
+        with subscribe(env, request) as subscription:
+            try:
+                await forward_events(subscription, send, keepalive)
+            except ConnectionResetError:
+                pass
+        return response
+
+    async def websocket_events(request):
+        """The events of the environment, as JSON messages over a WebSocket."""
+        env = get_env(request)
+        ws = web.WebSocketResponse(heartbeat=KEEPALIVE_INTERVAL)
+        await ws.prepare(request)
+
+        async def keepalive():
+            # the heartbeat keeps the connection open
+            pass
+
+        with subscribe(env, request) as subscription:
+            sender = asyncio.ensure_future(forward_events(subscription, ws.send_json, keepalive))
+            try:
+                # nothing is expected from the client, this returns when it closes
+                async for _ in ws:
+                    pass
+            finally:
+                sender.cancel()
+        return ws
+
+    @jsonresponse
+    async def get_usage(request):
+        env = get_env(request)
+        return env.usage()
+
     @jsonresponse
+    async def interrupt(request):
+        env = get_env(request)
+        env.interrupt()
+
     async def get_variable(request):
+        """
+        The value of a variable, streamed in the format asked for in the Accept header.
+        With start/stop in the query only that slice of the value is sent by the kernel.
+
+        The ETag is the version of the value: with If-None-Match, the value is only sent if it
+        changed (otherwise 304). With after=<version> the request waits (up to timeout seconds)
+        for a newer version, and answers 304 if there's none by then.
+        """
         env = get_env(request)
-        
+        negotiated = negotiate(request)
+        name = request.match_info['name']
+
         try:
-            value = env.get_variable(request.match_info['name'])
-        except NameError as e:
+            start, stop, after = [int(request.query[param]) if request.query.get(param) else None
+                                  for param in ('start', 'stop', 'after')]
+            timeout = min(float(request.query.get('timeout', LONG_POLL_TIMEOUT)),
+                          LONG_POLL_MAX_TIMEOUT)
+        except ValueError as e:
             raise web.HTTPBadRequest(text=str(e))
 
-        print("got", value)
-        return value
-        
+        if after is not None and await env.wait_version(name, after, timeout) <= after:
+            raise web.HTTPNotModified(headers={'ETag': '"{}"'.format(after)})
+
+        try:
+            await env.pull_variable(name)
+            version = env.version(name)
+            headers = {'ETag': '"{}"'.format(version), 'Vary': 'Accept'}
+            if any(etag.value in (str(version), '*') for etag in request.if_none_match or ()):
+                raise web.HTTPNotModified(headers=headers)
+            value = await env.get_variable(name, pull=False, start=start, stop=stop)
+        except (NameError, KeyError, TypeError, runner.PullFailed, subrpc.RemoteException) as e:
+            raise web.HTTPBadRequest(text=str(e))
+
+        return await stream_value(request, value, negotiated, headers)
+
+    async def get_variables(request):
+        """The values of the variables in the query (?name=a&name=b), as a name: value object."""
+        env = get_env(request)
+        negotiated = negotiate(request)
+
+        try:
+            values = await env.get_variables(request.query.getall('name', []))
+        except (NameError, KeyError, runner.PullFailed, subrpc.RemoteException) as e:
+            raise web.HTTPBadRequest(text=str(e))
+
+        return await stream_value(request, values, negotiated)
+
+    @jsonresponse
+    async def update_cells(request):
+        """
+        Create and update many cells at once: {"cells": [{"id", "code", "timeout",
+        "cpu_timeout"}...], "live"}, without an id for new cells. Either all the cells are
+        updated or none, and they are scheduled together. Returns the ids of the cells.
+        """
+        data = await request.json()
+        if not isinstance(data.get('cells'), list):
+            raise web.HTTPBadRequest(text="missing cells")
+        if not all('code' in item for item in data['cells']):
+            raise web.HTTPBadRequest(text="missing code")
+
+        env = get_env(request)
+
+        cells = []
+        new = []
+        for item in data['cells']:
+            cell_id = item.get('id')
+            try:
+                previous = env.cell_get(cell_id) if cell_id is not None else None
+            except KeyError:
+                previous = None
+            if previous is None:
+                new.append(len(cells))
+                cell = None
+            else:
+                # only re-analyze the statements that changed
+                cell = analysis.Cell(item['code'], previous=previous)
+            cells.append((cell_id, cell))
+
+        # the new code is analyzed in the process pool, while the server goes on
+        analyzed = await analysis.analyze_cells_async(
+            [data['cells'][i]['code'] for i in new], cache=analysis.cache)
+        for i, cell in zip(new, analyzed):
+            cells[i] = (cells[i][0], cell)
+
+        try:
+            cell_ids = env.cells_update(cells, live=data.get('live', True))
+        except (NameError, ValueError) as e:
+            raise web.HTTPBadRequest(text=str(e))
+
+        for cell_id, item in zip(cell_ids, data['cells']):
+            if 'timeout' in item or 'cpu_timeout' in item:
+                env.set_cell_timeouts(cell_id, item.get('timeout'), item.get('cpu_timeout'))
+
+        return cell_ids
+
     app = web.Application()
     app.add_routes([web.get('/', list_environments)])
     app.add_routes([web.post('/', create_environment)])
     app.add_routes([web.post('/{env}/cells', create_cell)])
     app.add_routes([web.post('/{env}/cells/{cell_id}', update_cell)])
+    app.add_routes([web.post('/{env}/batch/cells', update_cells)])
+    app.add_routes([web.get('/{env}/variables', get_variables)])
     app.add_routes([web.get('/{env}/variables/{name}', get_variable)])
-    
-    
+    app.add_routes([web.post('/{env}/interrupt', interrupt)])
+    app.add_routes([web.get('/{env}/usage', get_usage)])
+    app.add_routes([web.get('/{env}/events', stream_events)])
+    app.add_routes([web.get('/{env}/ws', websocket_events)])
+
+    # the kernels of the environments are killed (or given back to the pool) first
+    async def close_environments(app):
+        df.close()
+    app.on_cleanup.append(close_environments)
+
+    if kernel_pool is not None:
+        async def start_kernel_pool(app):
+            kernel_pool.fill()
+
+        async def close_kernel_pool(app):
+            kernel_pool.close()
+
+        app.on_startup.append(start_kernel_pool)
+        app.on_cleanup.append(close_kernel_pool)
+
+    async def close_analysis_pool(app):
+        analysis.pool.close()
+    app.on_cleanup.append(close_analysis_pool)
+
+    if analysis_cache_path:
+        async def save_analysis_cache(app):
+            analysis.cache.save()
+        app.on_cleanup.append(save_analysis_cache)
+
     return app
 
 if __name__ == "__main__":
-    app = build_app()
+    kernel_limits = None
+    if os.environ.get('DATAFLOCK_KERNEL_MEMORY') or os.environ.get('DATAFLOCK_KERNEL_CPU'):
+        kernel_limits = engine.ResourceLimits(
+            memory=int(os.environ.get('DATAFLOCK_KERNEL_MEMORY', 0)) or None,
+            cpu=float(os.environ.get('DATAFLOCK_KERNEL_CPU', 0)) or None,
+        )
+    app = build_app(
+        analysis_cache_path=os.environ.get('DATAFLOCK_ANALYSIS_CACHE'),
+        kernel_pool_size=int(os.environ.get('DATAFLOCK_KERNEL_POOL_SIZE', 0)),
+        kernel_max_uses=int(os.environ.get('DATAFLOCK_KERNEL_MAX_USES', 10)),
+        kernel_preload=os.environ.get('DATAFLOCK_KERNEL_PRELOAD', '').split(),
+        kernel_limits=kernel_limits,
+    )
     web.run_app(app)
@@ -1,11 +1,20 @@
 import multiprocessing
 import json
 from collections import namedtuple
+from queue import Empty
 import asyncio
 import aioprocessing
 import uuid
 import inspect
+import itertools
 import functools
+import os
+import glob
+import mmap
+import pickle
+import signal
+import struct
+import tempfile
 import types
 import traceback
 
@@ -34,42 +43,256 @@ class RemoteException(Exception):
         return self.repr
 
 
+class RemoteDied(Exception):
+    """The slave process was killed (or died) before answering."""
+
+
+# Framed mode: instead of pickling a Command/Response per call, the commands waiting to be sent
+# are batched in a frame (responses are sent as soon as they are ready, in a frame each). A frame is a header (payload length, number of out-of-band buffers),
+# the kind of every out-of-band buffer, the pickled list of messages and then every out-of-band
+# buffer as its own message, so big buffers are never copied into the pickle.
+# Buffers bigger than the shared threshold aren't sent through the pipe at all: they are copied
+# to a shared memory file, and only its path is sent. The receiver maps the file and unlinks it,
+# the memory is freed when the unpickled value is.
+# Commands are (id, cmd, args, kwargs) tuples with integer ids, responses are (id, ok, result),
+# where result is the remote exception data when not ok.
+FRAME_HEADER = struct.Struct("!II")
+INLINE = b"i"
+SHARED = b"s"
+
+SHARED_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+SHARED_THRESHOLD = 1 << 20
+
+OUTPUT_POLL_INTERVAL = 0.5
+
+
+class SharedBuffers:
+    """
+    Creates the shared memory files of one side of a channel, named after the channel's tag so
+    the ones never received can be removed.
+    """
+    def __init__(self, tag, threshold=SHARED_THRESHOLD):
+        self.tag = tag
+        self.threshold = threshold
+        self.names = itertools.count()
+
+    def share(self, buffer):
+        """
+        Copy the buffer to a new shared memory file, returning its path.
+        Raises OSError if there's no room for it.
+        """
+        path = os.path.join(SHARED_DIR, "dataflock-{}-{}-{}".format(
+            self.tag, os.getpid(), next(self.names)))
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o600)
+        try:
+            if hasattr(os, "posix_fallocate"):
+                # the memory is reserved now: a full /dev/shm is an OSError here, instead of a
+                # SIGBUS when writing to the mapping
+                os.posix_fallocate(fd, 0, buffer.nbytes)
+            else:
+                os.ftruncate(fd, buffer.nbytes)
+            with mmap.mmap(fd, buffer.nbytes) as shared:
+                shared[:] = buffer
+        except BaseException:
+            unlink(path)
+            raise
+        finally:
+            os.close(fd)
+        return path
+
+
+def attach_shared(path):
+    """Map a shared memory file, which is removed right away (the mapping stays valid)."""
+    fd = os.open(path, os.O_RDWR)
+    try:
+        return mmap.mmap(fd, os.fstat(fd).st_size)
+    finally:
+        os.close(fd)
+        unlink(path)
+
+
+def unlink(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def remove_shared(tag):
+    """Remove the shared memory files of a channel that were never received."""
+    for path in glob.glob(os.path.join(SHARED_DIR, "dataflock-{}-*".format(tag))):
+        unlink(path)
+
+
+def pack_frame(messages, shared=None):
+    """
+    Pickle the messages, returning the frame and its out-of-band buffers (or the paths of the
+    shared ones, if shared is a SharedBuffers).
+    """
+    kinds = []
+    buffers = []
+
+    def out_of_band(buffer):
+        if not memoryview(buffer).contiguous:
+            # a true value keeps it in-band
+            return True
+        raw = buffer.raw()
+        if shared is not None and raw.nbytes >= shared.threshold:
+            try:
+                path = shared.share(raw)
+            except OSError:
+                # no room in shared memory, it goes through the pipe
+                pass
+            else:
+                kinds.append(SHARED)
+                buffers.append(path)
+                return
+        kinds.append(INLINE)
+        buffers.append(raw)
+
+    try:
+        payload = pickle.dumps(messages, protocol=5, buffer_callback=out_of_band)
+    except BaseException:
+        for kind, buffer in zip(kinds, buffers):
+            if kind == SHARED:
+                unlink(buffer)
+        raise
+    header = FRAME_HEADER.pack(len(payload), len(buffers))
+    return header + b"".join(kinds) + payload, buffers
+
+
+def pack_frames(messages, on_error, shared=None):
+    """
+    Pack the messages in a frame, or in a frame per message if some can't be pickled.
+    on_error(message, exception) is called for the messages that can't.
+    """
+    try:
+        return [pack_frame(messages, shared)]
+    except Exception:
+        pass
+
+    frames = []
+    for message in messages:
+        try:
+            frames.append(pack_frame([message], shared))
+        except Exception as e:
+            on_error(message, e)
+    return frames
+
+
+def frame_kinds(frame):
+    _, nbuffers = FRAME_HEADER.unpack_from(frame)
+    return bytes(frame[FRAME_HEADER.size:FRAME_HEADER.size + nbuffers])
+
+
+def unpack_frame(frame, buffers):
+    size, nbuffers = FRAME_HEADER.unpack_from(frame)
+    payload = memoryview(frame)[FRAME_HEADER.size + nbuffers:]
+    if len(payload) != size:
+        raise ValueError("Truncated frame: {} bytes of {}".format(len(payload), size))
+    return pickle.loads(payload, buffers=buffers)
+
+
+def send_frame(channel, frame, buffers):
+    channel.send_bytes(frame)
+    for buffer in buffers:
+        if isinstance(buffer, str):
+            buffer = buffer.encode()
+        channel.send_bytes(buffer)
+
+
+async def recv_frame(channel):
+    frame = await channel.coro_recv_bytes()
+    buffers = []
+    for kind in frame_kinds(frame):
+        buffer = await channel.coro_recv_bytes()
+        if kind == SHARED[0]:
+            buffer = attach_shared(buffer.decode())
+        buffers.append(buffer)
+    return unpack_frame(frame, buffers)
+
+
 class SubRPCSlave:
     def __init__(self, channel, stdout, stderr):
         self.channel = channel
         self.stdout = stdout
         self.stderr = stderr
+        self.busy = 0
+
+    def on_interrupt(self, signum, frame):
+        # only interrupt the commands being executed, an idle slave ignores it
+        if self.busy:
+            raise KeyboardInterrupt()
 
     async def call(self, cmd):
         try:
-            func = getattr(self, cmd.cmd)
+            _, name, args, kwargs = cmd
+            func = getattr(self, name)
+            self.busy += 1
             try:
-                result = await func(*cmd.args, **cmd.kwargs)
-            except Exception as e:
-                print(dir(e))
-                evt = dict(
-                    args=e.args,
-                    repr=traceback.format_exc()
-                )
-                self.channel.send(RemoteExceptionData(cmd, evt))
+                result = await func(*args, **kwargs)
+            except (Exception, KeyboardInterrupt) as e:
+                self.reply(cmd, error=self.error_data(e))
             else:
-                self.channel.send(Response(cmd, result))
+                self.reply(cmd, result)
+            finally:
+                self.busy -= 1
         except Exception as e:
             print("wtf", e)
 
+    def error_data(self, e):
+        return dict(
+            args=e.args,
+            repr=traceback.format_exc()
+        )
+
+    def reply(self, cmd, result=None, error=None):
+        if not self.framed:
+            if error is None:
+                self.channel.send(Response(cmd, result))
+            else:
+                self.channel.send(RemoteExceptionData(cmd, error))
+            return
+
+        # sent right away: the next command may block the loop for a long time
+        if error is None:
+            response = (cmd[0], True, result)
+        else:
+            response = (cmd[0], False, error)
+
+        def unpicklable(response, e):
+            self.reply(response, error=self.error_data(e))
+
+        for frame, buffers in pack_frames([response], unpicklable, self.shared):
+            send_frame(self.channel, frame, buffers)
+
     async def _start(self):
         while True:
-            cmd = await self.channel.coro_recv()
-            asyncio.ensure_future(self.call(cmd))
+            if self.framed:
+                cmds = await recv_frame(self.channel)
+            else:
+                cmds = [await self.channel.coro_recv()]
+            for cmd in cmds:
+                asyncio.ensure_future(self.call(cmd))
 
-    def start(self):
+    def start(self, framed=False, shared=None):
+        self.framed = framed
+        self.shared = shared
+        signal.signal(signal.SIGINT, self.on_interrupt)
         loop = asyncio.new_event_loop()
         loop.run_until_complete(self._start())
         
 
 class SubRPCMaster:
-    def __init__(self, slave):
+    def __init__(self, slave, framed=False, shared_threshold=None, on_output=None,
+                 on_died=None):
         self.slave = slave
+        self.framed = framed
+        self.shared_threshold = shared_threshold
+        # called with the stream name and every item the slave puts on its stdout/stderr queues
+        self.on_output = on_output
+        # called when the slave process dies by itself (not when it's killed)
+        self.on_died = on_died
 
         for name, method in inspect.getmembers(slave): #, predicate=inspect.ismethod):
             if name.startswith("do_"):
@@ -85,18 +308,60 @@ class SubRPCMaster:
         self.start()
         
     async def listen_task(self):
+        channel = self.channel
         while True:
-            response = await self.channel.coro_recv()
-            cid = response.cmd.id
-            future = self.pending_cmds.pop(cid)
-            if isinstance(response, Response):
-                future.set_result(response.result)
-            else:
-                exc = RemoteException(response.exception)
-                future.set_exception(exc)
+            try:
+                if self.framed:
+                    responses = await recv_frame(channel)
+                else:
+                    responses = [await channel.coro_recv()]
+            except (EOFError, OSError):
+                self.dead = True
+                self.fail_pending()
+                self.remove_shared()
+                if self.channel is channel and self.on_died is not None:
+                    asyncio.get_event_loop().call_soon(self.on_died)
+                return
+            for response in responses:
+                self.resolve(response)
+
+    def resolve(self, response):
+        if self.framed:
+            cid, ok, result = response
+        elif isinstance(response, Response):
+            cid, ok, result = response.cmd.id, True, response.result
+        else:
+            cid, ok, result = response.cmd.id, False, response.exception
+
+        future = self.pending_cmds.pop(cid, None)
+        if future is None or future.done():
+            # nobody is waiting for it anymore (eg. cancelled)
+            return
+        if ok:
+            future.set_result(result)
+        else:
+            future.set_exception(RemoteException(result))
+
+    async def output_task(self, queue, stream):
+        # polls, to stop soon after the slave is killed (putting a sentinel could block forever
+        # on the queue's lock, if the slave was killed while holding it)
+        while queue is self.stdout_q or queue is self.stderr_q:
+            try:
+                item = await queue.coro_get(timeout=OUTPUT_POLL_INTERVAL)
+            except Empty:
+                continue
+            self.on_output(stream, item)
+
+    def fail_pending(self):
+        """Fail the commands waiting for an answer that will never come."""
+        pending, self.pending_cmds = self.pending_cmds, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(RemoteDied())
 
     def interrupt(self):
-        pass
+        """Interrupt the commands being executed in the slave."""
+        os.kill(self.process.pid, signal.SIGINT)
 
     def restart(self):
         self.kill()
@@ -104,30 +369,110 @@ class SubRPCMaster:
 
     def start(self):
         self.pending_cmds = {}
+        self.dead = False
+        self.ids = itertools.count()
+        self.shared = self.slave_shared = None
+        if self.framed and self.shared_threshold is not None:
+            tag = uuid.uuid4().hex
+            self.shared = SharedBuffers(tag + "m", self.shared_threshold)
+            self.slave_shared = SharedBuffers(tag + "s", self.shared_threshold)
+        self.outbox = []
+        self.flush_handle = None
         self.channel, client_channel = aioprocessing.AioPipe()
         self.stdout_q = sout = aioprocessing.AioQueue()
         self.stderr_q = serr = aioprocessing.AioQueue()
         self.listener = asyncio.ensure_future(self.listen_task())
+        self.output_readers = []
+        if self.on_output is not None:
+            self.output_readers = [
+                asyncio.ensure_future(self.output_task(sout, "stdout")),
+                asyncio.ensure_future(self.output_task(serr, "stderr")),
+            ]
         loop = asyncio.get_event_loop()
         kernel = self.slave(client_channel, sout, serr)
-        self.process = p = aioprocessing.AioProcess(target=kernel.start)
+        self.process = p = aioprocessing.AioProcess(
+            target=kernel.start, kwargs=dict(framed=self.framed, shared=self.slave_shared))
         p.start()
+        # the slave has its own copy now, closing ours lets us see EOF when the slave dies
+        client_channel.close()
 
     def kill(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+        self.outbox = []
         self.channel = None
         self.stdout_q = None
         self.stderr_q = None
         self.process.terminate()
         self.listener.cancel()
+        self.fail_pending()
+        self.remove_shared()
 
-    async def cmd(self, cmd_name, *args, **kwargs):
-        cmd = Command.new_command(cmd_name, *args, **kwargs)
+    def remove_shared(self):
+        """Remove the shared memory files in flight, that nobody will receive."""
+        for shared in (self.shared, self.slave_shared):
+            if shared is not None:
+                remove_shared(shared.tag)
+
+    def send(self, cmd_name, *args, **kwargs):
+        """
+        Send a command, returning the future of its result.
+        In framed mode, the commands sent in the same loop iteration go together in one frame.
+        """
         response = asyncio.Future()
-        self.pending_cmds[cmd.id] = response
-        self.channel.send(cmd)
-        return await response
+        if self.dead or self.channel is None:
+            # nobody will ever answer
+            response.set_exception(RemoteDied())
+            return response
+
+        if not self.framed:
+            cmd = Command.new_command(cmd_name, *args, **kwargs)
+            try:
+                self.channel.send(cmd)
+            except OSError:
+                response.set_exception(RemoteDied())
+            else:
+                self.pending_cmds[cmd.id] = response
+            return response
+
+        cid = next(self.ids)
+        self.pending_cmds[cid] = response
+        self.outbox.append((cid, cmd_name, args, kwargs))
+        if self.flush_handle is None:
+            self.flush_handle = asyncio.get_event_loop().call_soon(self.flush)
+        return response
+
+    def flush(self):
+        self.flush_handle = None
+        outbox, self.outbox = self.outbox, []
+
+        def unpicklable(cmd, e):
+            future = self.pending_cmds.pop(cmd[0], None)
+            if future is not None and not future.done():
+                future.set_exception(e)
+
+        try:
+            if self.channel is None:
+                raise BrokenPipeError("The slave was killed")
+            for frame, buffers in pack_frames(outbox, unpicklable, self.shared):
+                send_frame(self.channel, frame, buffers)
+        except OSError:
+            # the slave is gone: the commands of the batch will never be answered
+            for cmd in outbox:
+                future = self.pending_cmds.pop(cmd[0], None)
+                if future is not None and not future.done():
+                    future.set_exception(RemoteDied())
+
+    def notify(self, cmd_name, *args, **kwargs):
+        """Send a command without waiting for its result (errors are ignored)."""
+        future = self.send(cmd_name, *args, **kwargs)
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+
+    async def cmd(self, cmd_name, *args, **kwargs):
+        return await self.send(cmd_name, *args, **kwargs)
 
 
-def get_master_for(slave):
-    return SubRPCMaster(slave)
+def get_master_for(slave, framed=False, shared_threshold=None, on_output=None, on_died=None):
+    return SubRPCMaster(slave, framed=framed, shared_threshold=shared_threshold,
+                        on_output=on_output, on_died=on_died)
 
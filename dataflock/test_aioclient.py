@@ -0,0 +1,151 @@
+import asyncio
+import json
+import multiprocessing
+from contextlib import asynccontextmanager
+
+import aiohttp
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+import aioclient
+import engine
+import server
+
+
+@asynccontextmanager
+async def client():
+    test_server = TestServer(server.build_app(kernel_factory=engine.KernelProxy))
+    await test_server.start_server()
+    try:
+        async with aioclient.AsyncClient(str(test_server.make_url('/'))) as c:
+            yield c
+    finally:
+        await test_server.close()
+
+
+@pytest.mark.asyncio
+async def test_client():
+    async with client() as c:
+        await c.create_environment("test")
+        assert json.loads(await c.list_environments()) == ["test"]
+
+        a, b = json.loads(await c.create_cells("test", ["a = list(range(10))", "b = len(a)"]))
+        assert json.loads(await c.get("test", "b")) == 10
+        assert json.loads(await c.get("test", "a", start=2, stop=4)) == [2, 3]
+
+        await c.update_cell("test", a, "a = [1]")
+        assert json.loads(await c.get_many("test", ["a", "b"])) == dict(a=[1], b=1)
+
+        # dependency loops are the client's error
+        await c.create_cell("test", "x = y")
+        with pytest.raises(aiohttp.ClientResponseError) as error:
+            await c.create_cell("test", "y = x")
+        assert error.value.status == 400
+        with pytest.raises(aiohttp.ClientResponseError) as error:
+            await c.update_cell("test", a, "a = b")
+        assert error.value.status == 400
+        assert json.loads(await c.get("test", "a")) == [1]
+
+        # values that can't be sent as JSON aren't replaced by their repr
+        await c.create_cell("test", "s = {1, 2}")
+        with pytest.raises(aiohttp.ClientResponseError) as error:
+            await c.get("test", "s")
+        assert error.value.status == 406
+
+
+@pytest.mark.asyncio
+async def test_fan_out():
+    async with client() as c:
+        environments = ["env{}".format(i) for i in range(5)]
+        await asyncio.gather(*[c.create_environment(env) for env in environments])
+        await c.fan_out("create_cell", environments, "a = 1")
+        results = await c.fan_out("get", environments, "a")
+        assert results == dict((env, "1") for env in environments)
+
+
+@pytest.mark.asyncio
+async def test_events():
+    async with client() as c:
+        await c.create_environment("test")
+        await c.create_cell("test", "a = 1")
+
+        received = []
+        async for event in c.events("test", replay=True):
+            received.append(event['event'])
+            if event['event'] == "updated":
+                break
+        assert received == ["created", "dirtied", "running", "finished", "updated"]
+
+
+@pytest.mark.asyncio
+async def test_poll():
+    async with client() as c:
+        await c.create_environment("test")
+        cell = json.loads(await c.create_cell("test", "a = 1"))
+        version, value = await c.poll("test", "a")
+        assert json.loads(value) == 1
+        assert await c.poll("test", "a", version) == (version, None)
+
+        # a run that gives the same value keeps the version
+        await c.update_cell("test", cell, "a = 2 - 1")
+        assert await c.poll("test", "a", version, wait=0.2) == (version, None)
+
+        waiting = asyncio.ensure_future(c.poll("test", "a", version, wait=5))
+        await asyncio.sleep(0.1)
+        assert not waiting.done()
+        await c.update_cell("test", cell, "a = 2")
+        new_version, value = await asyncio.wait_for(waiting, 5)
+        assert new_version > version
+        assert json.loads(value) == 2
+
+
+@pytest.mark.asyncio
+async def test_events_cancelled():
+    app = server.build_app(kernel_factory=engine.KernelProxy)
+    cancelled = asyncio.Event()
+
+    @web.middleware
+    async def record_cancel(request, handler):
+        try:
+            return await handler(request)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+    app.middlewares.append(record_cancel)
+
+    # the handlers are cancelled when their client goes away
+    test_server = TestServer(app)
+    await test_server.start_server()
+    try:
+        async with aioclient.AsyncClient(str(test_server.make_url('/'))) as c:
+            await c.create_environment("test")
+            await c.create_cell("test", "a = 1")
+            async for event in c.events("test", replay=True):
+                if event['event'] == "updated":
+                    break
+
+        # the client went away while the handler waited for events
+        await asyncio.wait_for(cancelled.wait(), 5)
+    finally:
+        await test_server.close()
+
+
+@pytest.mark.asyncio
+async def test_shutdown_kills_kernels():
+    before = set(multiprocessing.active_children())
+    test_server = TestServer(server.build_app(kernel_factory=engine.SubprocessKernel))
+    await test_server.start_server()
+    try:
+        async with aioclient.AsyncClient(str(test_server.make_url('/'))) as c:
+            await c.create_environment("test")
+            await c.create_cell("test", "a = 1")
+            assert json.loads(await c.get("test", "a")) == 1
+        kernels = set(multiprocessing.active_children()) - before
+        assert kernels
+    finally:
+        await test_server.close()
+
+    for process in kernels:
+        process.join(5)
+        assert not process.is_alive()
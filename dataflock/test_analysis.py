@@ -1,6 +1,10 @@
+import ast
 from textwrap import dedent
 
-from analysis import Cell, find_missing_vars
+import pytest
+
+import analysis
+from analysis import AnalysisCache, Cell, ScopeTreeNode, analyze, analyze_cells, analyze_cells_async, find_missing_vars
 
 
 def test_exposed_variables():
@@ -25,6 +29,137 @@ def test_depend_variables_are_found_using_analysis(mocker):
     assert c.depends == fake_find_missing.return_value
 
 
+def test_analyze_returns_depends_exposes_and_scope_tree():
+    text = dedent("""
+        hola = 1
+        def f(x):
+            y = x
+        chau = hola + mundo + f(cruel)
+    """)
+
+    result = analyze(text)
+    assert result.depends == {"mundo", "cruel"}
+    assert result.exposes == {"chau", "hola", "y"}
+    assert isinstance(result.scope_root, ScopeTreeNode)
+    assert find_missing_vars(result.scope_root) == find_missing_vars(text)
+
+
+def test_analysis_cache_hits_and_misses():
+    cache = AnalysisCache(maxsize=2)
+
+    c1 = Cell("a = b", cache=cache)
+    c2 = Cell("a = b", cache=cache)
+    assert c1.depends == c2.depends == {"b"}
+    assert c1.exposes == c2.exposes == {"a"}
+    assert cache.stats() == dict(hits=1, misses=1, size=1, maxsize=2)
+
+    Cell("c = 1", cache=cache)
+    Cell("d = 1", cache=cache)  # evicts "a = b", the least recently used
+    Cell("a = b", cache=cache)
+    assert cache.stats() == dict(hits=1, misses=4, size=2, maxsize=2)
+
+
+def test_analysis_cache_persistence(tmpdir):
+    path = str(tmpdir.join("analysis.cache"))
+
+    cache = AnalysisCache(path=path)
+    cache.load()  # no file yet, starts cold
+    Cell("a = b", cache=cache)
+    cache.save()
+
+    warm = AnalysisCache(path=path)
+    warm.load()
+    assert Cell("a = b", cache=warm).depends == {"b"}
+    assert warm.stats()["hits"] == 1
+    assert warm.stats()["misses"] == 0
+
+
+INCREMENTAL_VERSIONS = [
+    dedent("""
+        a = 10
+        print(f)
+        def f(b):
+            return a + b + c
+    """),
+    dedent("""
+        a = 11
+        print(f)
+        def f(b):
+            return a + b + c
+    """),
+    dedent("""
+        a = 11
+        if a:
+            del a
+        print(f, a)
+        @decorate
+        def f(b):
+            return a + b + c
+    """),
+    dedent("""
+        a = 11; del a
+        print(f, a)
+        class f:
+            b = c
+            d = b
+    """),
+    dedent("""
+        try:
+            a = 1
+        finally:
+            del a
+        x, y = 1, 2
+    """),
+]
+
+
+@pytest.mark.parametrize("old_code", INCREMENTAL_VERSIONS)
+@pytest.mark.parametrize("new_code", INCREMENTAL_VERSIONS)
+def test_incremental_analysis_matches_full_analysis(old_code, new_code):
+    previous = Cell(old_code, previous=Cell(old_code))
+    cell = Cell(new_code, previous=previous)
+    full = Cell(new_code)
+
+    assert cell.depends == full.depends
+    assert cell.exposes == full.exposes
+    assert cell.same_interface(full)
+
+
+def test_incremental_analysis_reuses_unchanged_statements(mocker):
+    previous = Cell(INCREMENTAL_VERSIONS[0], previous=Cell(""))
+    spy = mocker.spy(analysis, 'analyze_statement')
+
+    cell = Cell(INCREMENTAL_VERSIONS[1], previous=previous)
+
+    assert spy.call_count == 1  # only "a = 11" changed
+    assert cell.same_interface(previous)
+    assert not cell.same_interface(Cell(INCREMENTAL_VERSIONS[3]))
+
+
+@pytest.mark.parametrize("max_workers", [1, 2])
+def test_analyze_cells(max_workers):
+    cells = analyze_cells(["a = 1", "b = a + c"], max_workers=max_workers)
+
+    assert [cell.code for cell in cells] == ["a = 1", "b = a + c"]
+    assert [cell.exposes for cell in cells] == [{"a"}, {"b"}]
+    assert [cell.depends for cell in cells] == [set(), {"a", "c"}]
+
+
+@pytest.mark.asyncio
+async def test_analyze_cells_async():
+    cache = AnalysisCache()
+    cache.get("a = 1")
+    cells = await analyze_cells_async(["a = 1", "b = a + c", "d = b"], chunksize=1, cache=cache)
+
+    assert [cell.exposes for cell in cells] == [{"a"}, {"b"}, {"d"}]
+    assert [cell.depends for cell in cells] == [set(), {"a", "c"}, {"b"}]
+    # only the code that wasn't cached went to the pool, and it's cached now
+    assert cache.stats()['hits'] == 1
+    assert "d = b" in cache
+    # the pool is kept for the next ones
+    assert analysis.pool.executor() is analysis.pool.executor()
+
+
 def test_builtins_are_ignored():
     sample_code = dedent("""
         sum([10, 20])
@@ -382,6 +517,63 @@ def test_complex_nested_scopes_handled_right():
     assert find_missing_vars(sample_code) == set()
 
 
+def test_scope_tree_visits_nodes_in_pre_order():
+    # a node's children are visited together, then each child subtree in order
+    sample_code = dedent("""
+        a = b
+        def f(c):
+            d = c
+        e = [g for g in h]
+    """)
+    scope_root = ScopeTreeNode.build_from_ast_node(ast.parse(sample_code))
+
+    assert [(use.kind.name, use.name) for use in scope_root.variable_uses] == [
+        ("SET", "f"), ("SET", "a"), ("READ", "b"), ("SET", "e"),
+        ("READ", "g"), ("SET", "g"), ("READ", "h"),
+    ]
+    assert [(use.kind.name, use.name) for use in scope_root.children[0].variable_uses] == [
+        ("SET", "c"), ("SET", "d"), ("READ", "c"),
+    ]
+
+
+def test_scope_symbol_table_keeps_first_set():
+    sample_code = dedent("""
+        print(a)
+        a = 1
+        a = 2
+        def f(b):
+            pass
+    """)
+    exposes = set()
+    scope_root = ScopeTreeNode.build_from_ast_node(ast.parse(sample_code), exposes=exposes)
+
+    assert exposes == {"a"}
+    assert set(scope_root.symbols) == {"a", "f"}
+    first_set = scope_root.variable_uses[scope_root.symbols["a"]]
+    assert (first_set.kind.name, first_set.name) == ("SET", "a")
+    assert scope_root.children[0].symbols == {"b": 0}
+    assert scope_root.children[0].variable_in_parent_scopes("a")
+    assert not scope_root.children[0].variable_in_parent_scopes("b")
+
+
+def test_analysis_can_drop_the_ast():
+    sample_code = dedent("""
+        def f(a):
+            return a + b
+    """)
+    result = analyze(sample_code, keep_ast=False)
+
+    assert result.depends == {"b"}
+    assert result.scope_root.ast_node is None
+    assert result.scope_root.children[0].ast_node is None
+    assert result.scope_root.children[0].node_type == "FunctionDef"
+
+
+def test_large_generated_cells():
+    sample_code = "config = {" + ", ".join("'k%d': v%d" % (i, i) for i in range(50000)) + "}"
+    assert len(find_missing_vars(sample_code)) == 50000
+
+
 # TODO globals vs locals
 #   - set a global from local scope?
 #   - del a global from local scope?
@@ -0,0 +1,60 @@
+import json
+
+import pytest
+
+import encoding
+
+
+def test_json_chunks():
+    value = {"items": list(range(100000)), "name": "x"}
+    chunks = list(encoding.encode_json(value))
+    assert len(chunks) > 1
+    assert all(len(chunk) >= encoding.CHUNK_SIZE for chunk in chunks[:-1])
+    assert json.loads(b"".join(chunks)) == value
+
+    # values JSON can't encode are an error, not their repr
+    with pytest.raises(TypeError):
+        b"".join(encoding.encode_json({1, 2}))
+
+
+def test_json_numpy():
+    numpy = pytest.importorskip("numpy")
+    value = {"array": numpy.arange(2000).reshape(2, 1000), "scalar": numpy.float32(0.5)}
+    assert json.loads(b"".join(encoding.encode_json(value))) == {
+        "array": [list(range(1000)), list(range(1000, 2000))], "scalar": 0.5}
+
+
+def test_parse_accept():
+    assert encoding.parse_accept("text/html;q=0.5, application/json, */*;q=0.1") == [
+        ("application/json", 1.0), ("text/html", 0.5), ("*/*", 0.1)]
+
+
+def test_negotiate():
+    assert encoding.negotiate(None)[0] == encoding.JSON
+    assert encoding.negotiate("*/*")[0] == encoding.JSON
+    assert encoding.negotiate("text/html, application/json;q=0.9")[0] == encoding.JSON
+    assert encoding.negotiate("text/html") is None
+    assert encoding.negotiate("application/json;q=0") is None
+
+
+def test_npy():
+    numpy = pytest.importorskip("numpy")
+    import io
+    array = numpy.arange(100000, dtype="float64").reshape(1000, 100)
+    data = b"".join(encoding.encode_npy(array))
+    assert (numpy.load(io.BytesIO(data)) == array).all()
+    assert encoding.negotiate("application/x-npy")[0] == encoding.NPY
+
+
+def test_msgpack():
+    msgpack = pytest.importorskip("msgpack")
+    value = list(range(100000))
+    assert msgpack.unpackb(b"".join(encoding.encode_msgpack(value))) == value
+    assert msgpack.unpackb(b"".join(encoding.encode_msgpack({"a": 1}))) == {"a": 1}
+
+
+def test_arrow():
+    pyarrow = pytest.importorskip("pyarrow")
+    data = b"".join(encoding.encode_arrow(list(range(1000))))
+    table = pyarrow.ipc.open_stream(data).read_all()
+    assert table.column("value").to_pylist() == list(range(1000))
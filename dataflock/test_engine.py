@@ -0,0 +1,385 @@
+import asyncio
+import hashlib
+import os
+import pickle
+from contextlib import contextmanager
+
+import pytest
+
+import analysis
+import engine
+import runner
+import subrpc
+
+
+@pytest.mark.asyncio
+async def test_kernel_proxy():
+    kernel = engine.KernelProxy()
+
+    await kernel.run("a = 1", set(), {"a"})
+    await kernel.run("b = a + 1", {"a"}, {"b"})
+    assert await kernel.get("b") == 2
+
+    kernel.restart()
+    with pytest.raises(KeyError):
+        await kernel.get("b")
+
+
+@pytest.mark.asyncio
+async def test_kernel_namespace():
+    kernel = engine.KernelProxy()
+    await kernel.run("a = 1", set(), {"a"})
+    # functions of a cell see the variables of the environment
+    await kernel.run("import math\ndef f():\n    return a + 1\nb = f()", {"a"}, {"b"})
+    assert await kernel.get("b") == 2
+
+    # only the exposed values are kept
+    with pytest.raises(KeyError):
+        await kernel.get("math")
+
+    # the builtins aren't a variable, the functions still have them
+    with pytest.raises(KeyError):
+        await kernel.get("__builtins__")
+    await kernel.run("def g():\n    return len([a])", {"a"}, {"g"})
+    await kernel.run("c = g()", {"g"}, {"c"})
+    assert await kernel.get("c") == 1
+    assert "__builtins__" not in kernel.variables
+
+
+def test_fingerprint():
+    assert engine.fingerprint([1, "a"]) == engine.fingerprint([1, "a"])
+    assert engine.fingerprint([1, "a"]) != engine.fingerprint([1, "b"])
+    assert engine.fingerprint(lambda: None) is None
+
+    # buffers are hashed in place
+    data = bytearray(b"x" * 1000)
+    first = engine.fingerprint(pickle.PickleBuffer(data))
+    data[-1] = ord("y")
+    assert engine.fingerprint(pickle.PickleBuffer(data)) != first
+
+    # the pickle is hashed as it's written, the same as hashing it whole
+    value = [str(i) for i in range(100000)]
+    assert engine.fingerprint(value) == hashlib.blake2b(
+        pickle.dumps(value, protocol=5), digest_size=16).hexdigest()
+
+
+@pytest.mark.asyncio
+async def test_kernel_without_fingerprints():
+    kernel = engine.KernelProxy()
+    kernel.set_fingerprints(False)
+    info = await kernel.run("a = 1", set(), {"a"})
+    assert info['fingerprints'] == {"a": None}
+
+    # the memo needs them
+    kernel.set_memo(1)
+    info = await kernel.run("a = 1", set(), {"a"})
+    assert info['fingerprints'] == {"a": engine.fingerprint(1)}
+
+
+@pytest.mark.asyncio
+async def test_kernel_memo():
+    kernel = engine.KernelProxy()
+    kernel.set_memo(1)
+    info = await kernel.run("a = 1", set(), {"a"})
+    assert info == dict(fingerprints={"a": engine.fingerprint(1)}, memoized=False)
+
+    await kernel.run("b = [a]", {"a"}, {"b"})
+    info = await kernel.run("b = [a]", {"a"}, {"b"})
+    assert info['memoized']
+
+    # evicted by a newer run
+    await kernel.run("c = [a]", {"a"}, {"c"})
+    assert not (await kernel.run("b = [a]", {"a"}, {"b"}))['memoized']
+
+
+@pytest.mark.asyncio
+async def test_kernel_output():
+    output = []
+    kernel = engine.KernelProxy()
+    kernel.set_output(lambda *args: output.append(args))
+
+    await kernel.run("print('hello')", set(), set(), "c1")
+    await kernel.run("import sys; sys.stderr.write('x' * 5000)", set(), set(), "c2")
+    assert output == [
+        ("c1", "stdout", "hello\n"),
+        ("c2", "stderr", "x" * engine.OUTPUT_CHUNK_SIZE),
+        ("c2", "stderr", "x" * (5000 - engine.OUTPUT_CHUNK_SIZE)),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_kernel_timeouts():
+    kernel = engine.KernelProxy()
+    with pytest.raises(engine.CellTimeout):
+        await kernel.run("import time\nwhile True: time.sleep(0.01)", set(), set(), timeout=0.1)
+    with pytest.raises(engine.CellTimeout):
+        await kernel.run("while True: pass", set(), set(), cpu_timeout=0.1)
+
+    # the timers are disarmed after the cell
+    await kernel.run("import time; time.sleep(0.2); a = 1", set(), {"a"}, timeout=0.1 + 1)
+    assert await kernel.get("a") == 1
+
+
+@pytest.mark.asyncio
+async def test_kernel_interrupt():
+    kernel = engine.KernelProxy()
+    runs = [asyncio.ensure_future(kernel.run("a = 1", set(), {"a"})) for _ in range(3)]
+    await asyncio.sleep(0)
+    kernel.interrupt()
+
+    # the runs that didn't start are dropped
+    for run in runs:
+        with pytest.raises(engine.CellInterrupted):
+            await run
+    await kernel.run("a = 2", set(), {"a"})
+    assert await kernel.get("a") == 2
+
+
+@contextmanager
+def subprocess_kernel():
+    kernel = engine.SubprocessKernel()
+    try:
+        yield kernel
+    finally:
+        kernel.kill()
+
+
+@pytest.mark.asyncio
+async def test_subprocess_kernel():
+    with subprocess_kernel() as kernel:
+        await kernel.run("a = 1", set(), {"a"})
+        await kernel.run("b = a + 1", {"a"}, {"b"})
+        assert await kernel.get("b") == 2
+
+        with pytest.raises(subrpc.RemoteException):
+            await kernel.run("c = 1 / 0", set(), {"c"})
+
+        # slices are taken by the kernel
+        await kernel.run("d = list(range(100))", set(), {"d"})
+        assert await kernel.get("d", 10, 20) == list(range(10, 20))
+        assert await kernel.get("d", stop=3) == [0, 1, 2]
+        with pytest.raises(subrpc.RemoteException):
+            await kernel.get("a", 0, 1)
+
+
+@pytest.mark.asyncio
+async def test_subprocess_kernel_interrupt():
+    with subprocess_kernel() as kernel:
+        running = asyncio.ensure_future(kernel.run("while True: pass", set(), set()))
+        await asyncio.sleep(0.5)
+        kernel.interrupt()
+
+        with pytest.raises(subrpc.RemoteException) as error:
+            await running
+        assert "KeyboardInterrupt" in str(error.value)
+
+        # still usable after the interruption
+        await kernel.run("a = 1", set(), {"a"})
+        assert await kernel.get("a") == 1
+
+
+@pytest.mark.asyncio
+async def test_subprocess_kernel_restart():
+    with subprocess_kernel() as kernel:
+        await kernel.run("a = 1", set(), {"a"})
+        kernel.restart()
+
+        with pytest.raises(subrpc.RemoteException):
+            await kernel.get("a")
+
+
+
+@pytest.mark.asyncio
+async def test_subprocess_kernel_timeouts():
+    with subprocess_kernel() as kernel:
+        await kernel.run("a = 1", set(), {"a"})
+        with pytest.raises(subrpc.RemoteException) as error:
+            await kernel.run("while True: pass", set(), set(), cpu_timeout=0.1)
+        assert "CellTimeout" in str(error.value)
+        assert await kernel.get("a") == 1
+
+        # a cell that ignores the timer gets the kernel restarted
+        kernel.timeout_grace = 0.2
+        code = "import signal\nsignal.signal(signal.SIGALRM, signal.SIG_IGN)\nwhile True: pass"
+        with pytest.raises(engine.KernelRestarted):
+            await kernel.run(code, set(), set(), timeout=0.1)
+        with pytest.raises(subrpc.RemoteException):
+            await kernel.get("a")
+
+
+@pytest.mark.asyncio
+async def test_subprocess_kernel_timeouts_queued():
+    with subprocess_kernel() as kernel:
+        kernel.timeout_grace = 0.2
+        # together they take longer than the timeout, but none of them does
+        code = "import time; time.sleep(0.5)"
+        await asyncio.gather(*[kernel.run(code, set(), set(), timeout=0.8) for _ in range(3)])
+        assert kernel.stats['restarts'] == 0
+
+
+def test_process_usage():
+    rss, cpu_time = engine.process_usage(os.getpid())
+    assert rss > 0
+    assert cpu_time > 0
+
+
+@pytest.mark.asyncio
+async def test_kernel_memory_limit():
+    restarts = []
+    with subprocess_kernel() as kernel:
+        kernel.monitor_interval = 0.05
+        kernel.set_on_restart(restarts.append)
+        await kernel.run("a = 1", set(), set())
+        rss = kernel.usage()['rss']
+        kernel.set_limits(engine.ResourceLimits(memory=rss + 50 * 2 ** 20))
+
+        with pytest.raises(subrpc.RemoteDied):
+            await kernel.run("import time\nx = b'x' * 100 * 2 ** 20\ntime.sleep(5)", set(), set())
+        assert restarts == ["memory"]
+        assert kernel.usage()['memory_kills'] == 1
+
+        # the limits still apply to the new process
+        await kernel.run("a = 1", set(), {"a"})
+        assert kernel.monitor is not None
+
+
+@pytest.mark.asyncio
+async def test_kernel_cpu_limit():
+    restarts = []
+    with subprocess_kernel() as kernel:
+        kernel.monitor_interval = 0.05
+        kernel.set_on_restart(restarts.append)
+        kernel.set_limits(engine.ResourceLimits(cpu=0.2, window=0.3))
+
+        with pytest.raises(subrpc.RemoteDied):
+            await kernel.run("while True: pass", set(), set())
+        assert restarts == ["cpu"]
+
+
+@pytest.mark.asyncio
+async def test_kernel_address_space_limit():
+    with subprocess_kernel() as kernel:
+        await kernel.run("a = 1", set(), set())
+        with open("/proc/{}/statm".format(kernel.rpc.process.pid)) as statm:
+            size = int(statm.read().split()[0]) * engine.PAGE_SIZE
+        kernel.set_limits(engine.ResourceLimits(address_space=size + 100 * 2 ** 20))
+
+        with pytest.raises(subrpc.RemoteException) as error:
+            await kernel.run("x = b'x' * 500 * 2 ** 20", set(), set())
+        assert "MemoryError" in str(error.value)
+
+        kernel.set_limits(None)
+        await kernel.run("x = b'x' * 500 * 2 ** 20", set(), set())
+
+
+@pytest.mark.asyncio
+async def test_subprocess_kernel_output():
+    output = asyncio.Queue()
+    with subprocess_kernel() as kernel:
+        kernel.set_output(lambda *args: output.put_nowait(args))
+        await kernel.run("print('hello')", set(), set(), "c1")
+        assert await asyncio.wait_for(output.get(), 5) == ("c1", "stdout", "hello\n")
+
+
+@pytest.mark.asyncio
+async def test_kernel_pool():
+    pool = engine.KernelPool(size=2, max_uses=2, factory=engine.KernelProxy)
+    pool.fill()
+    first, second = pool._idle
+
+    kernel = pool.lease()
+    assert kernel is first
+    await asyncio.sleep(0)  # refilled
+    assert len(pool._idle) == 2
+
+    # released kernels are reset, and leased first
+    await kernel.run("a = 1", set(), {"a"})
+    pool.release(kernel)
+    assert pool._idle[0] is kernel
+    assert len(pool._idle) == 2
+    with pytest.raises(KeyError):
+        await kernel.get("a")
+
+    # it's been used max_uses times, so it won't be reused again
+    assert pool.lease() is kernel
+    pool.release(kernel)
+    assert kernel not in pool._idle
+
+    pool.close()
+    assert not pool._idle
+    assert pool.stats['leased'] == 2
+    assert pool.stats['reused'] == 1
+
+
+@pytest.mark.asyncio
+async def test_kernel_pool_environments():
+    pool = engine.KernelPool(size=1, preload=["json"])
+    flock = runner.DataFlock(kernel_pool=pool)
+    pool.fill()
+    try:
+        env = flock.environment_create("test")
+        kernel = env.kernel
+        await kernel.run("a = 1", set(), {"a"})
+        kernel.restart()
+        await kernel.run("a = 1", set(), {"a"})
+        assert env.usage()['restarts'] == 1
+        flock.environemnt_delete("test")
+
+        # the same kernel is leased again, without the old variables or counters
+        env = flock.environment_create("test")
+        assert env.kernel is kernel
+        with pytest.raises(subrpc.RemoteException):
+            await env.get_variable("a")
+        assert env.usage()['restarts'] == 0
+        flock.environemnt_delete("test")
+        assert pool.stats['reused'] == 2
+        assert pool.stats['cold_starts'] == 0
+    finally:
+        pool.close()
+
+
+@pytest.mark.asyncio
+async def test_kernel_pool_deleted_environment():
+    pool = engine.KernelPool(size=1)
+    flock = runner.DataFlock(kernel_pool=pool)
+    pool.fill()
+    try:
+        env = flock.environment_create("tenant1")
+        env.set_max_concurrency(1)
+        kernel = env.kernel
+        env.cell_create(analysis.Cell("x = 0\nfor i in range(2000000):\n    x += i"))
+        env.cell_create(analysis.Cell("secret = 42"))
+        await asyncio.sleep(0.1)
+        flock.environemnt_delete("tenant1")
+
+        # the kernel was still running a cell, it isn't given to anyone else
+        env = flock.environment_create("tenant2")
+        assert env.kernel is not kernel
+        await asyncio.sleep(1)
+        with pytest.raises(subrpc.RemoteException):
+            await env.kernel.get("secret")
+        assert pool.stats['retired'] == 1
+        flock.environemnt_delete("tenant2")
+    finally:
+        pool.close()
+
+
+@pytest.mark.asyncio
+async def test_kernel_pool_cancels_pending_runs():
+    pool = engine.KernelPool(size=1, factory=engine.KernelProxy)
+    flock = runner.DataFlock(kernel_pool=pool)
+    pool.fill()
+    deleted = flock.environment_create("tenant1")
+    kernel = deleted.kernel
+    # dispatched, but not run yet
+    deleted.cell_create(analysis.Cell("secret = 42"))
+    flock.environemnt_delete("tenant1")
+
+    env = flock.environment_create("tenant2")
+    assert env.kernel is kernel
+    await asyncio.sleep(0.1)
+    with pytest.raises(KeyError):
+        await env.kernel.get("secret")
+    # the deleted environment can't reach the kernel anymore
+    with pytest.raises(runner.EnvironmentClosed):
+        await deleted.get_variable("secret")
@@ -0,0 +1,30 @@
+import pytest
+
+import events
+
+
+@pytest.mark.asyncio
+async def test_broadcast():
+    broadcaster = events.Broadcaster()
+    with broadcaster.subscribe() as first, broadcaster.subscribe() as second:
+        broadcaster.publish("a")
+        broadcaster.publish("b")
+        assert [await first.get(), await first.get()] == ["a", "b"]
+        assert await second.get() == "a"
+    assert not broadcaster.subscribers
+
+    # late subscribers can replay the history
+    with broadcaster.subscribe(replay=True) as late:
+        assert await late.get() == "a"
+
+
+def test_bounded():
+    broadcaster = events.Broadcaster(maxlen=3, queue_size=2)
+    slow = broadcaster.subscribe()
+    for i in range(5):
+        broadcaster.publish(i)
+
+    assert list(broadcaster.history) == [2, 3, 4]
+    assert slow.queue.qsize() == 2
+    assert broadcaster.stats() == dict(
+        published=5, dropped=2, buffered=3, subscribers=1, subscribers_dropped=3)
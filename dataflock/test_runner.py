@@ -1,5 +1,11 @@
+import asyncio
+import os
+import random
+import signal
+
 import pytest
 
+import engine
 import runner
 import analysis
 
@@ -221,3 +227,644 @@ def test_live(env):
 
     assert env.is_running(cid3)
     
+
+
+def test_update_with_same_interface_keeps_graph(env, mocker):
+    c1 = analysis.Cell("a = 1")
+    c2 = analysis.Cell("b = a + 1")
+
+    cid1 = env.cell_create(c1)
+    cid2 = env.cell_create(c2)
+
+    loop_check = mocker.spy(env, 'raise_if_loop')
+    c2_new = analysis.Cell("b = a + 2", previous=c2)
+    env.cell_update(cid2, c2_new)
+
+    assert loop_check.call_count == 0
+    assert env.cell_get(cid2) is c2_new
+    assert env.depends('a') == {cid2}
+    assert env.exposes('b') == cid2
+
+
+def test_cells_create(env):
+    c0 = analysis.Cell("z = 1")
+    cid0 = env.cell_create(c0)
+    env.on_cell_run_finished(cid0)
+
+    cells = [analysis.Cell(code) for code in ["b = a + z", "a = 1", "c = b"]]
+    cid1, cid2, cid3 = env.cells_create(cells)
+
+    assert env.exposes('a') == cid2
+    assert env.depends('a') == {cid1}
+    assert env.depends('z') == {cid1}
+
+    # only the cell without dirty parents starts, the rest waits for it
+    assert env.is_running(cid2)
+    assert not env.is_running(cid1)
+    assert all(env.is_dirty(c) for c in [cid1, cid2, cid3])
+
+    env.on_cell_run_finished(cid2)
+    assert env.is_running(cid1)
+
+
+def test_cells_create_is_atomic(env):
+    env.cell_create(analysis.Cell("a = c"))
+
+    with pytest.raises(ValueError):  # loop!
+        env.cells_create([analysis.Cell("b = a"), analysis.Cell("c = b")])
+
+    with pytest.raises(NameError):
+        env.cells_create([analysis.Cell("b = 1"), analysis.Cell("b = 2")])
+
+    assert len(env.get_cells()) == 1
+    with pytest.raises(KeyError):
+        env.exposes('b')
+    assert env.depends('b') == set()
+
+
+def test_cells_update(env):
+    a, b = env.cells_create([analysis.Cell("a = 1"), analysis.Cell("b = a")], live=False)
+
+    # the variable moves from a cell to another, and a new cell uses it
+    c, _, d = env.cells_update([(a, analysis.Cell("c = 1")), (b, analysis.Cell("a = c")),
+                                (None, analysis.Cell("d = a"))], live=False)
+    assert c == a
+    assert env.exposes('a') == b
+    assert env.exposes('d') == d
+    assert env.dependent_cells(a) == {b}
+    assert_valid_order(env)
+
+    with pytest.raises(ValueError):  # loop!
+        env.cells_update([(a, analysis.Cell("c = d"))])
+    with pytest.raises(NameError):
+        env.cells_update([(a, analysis.Cell("d = 1")), (None, analysis.Cell("e = 1"))])
+
+    assert len(env.get_cells()) == 3
+    assert env.exposes('c') == a
+    assert env.depends('d') == set()
+    with pytest.raises(KeyError):
+        env.exposes('e')
+
+
+@pytest.mark.asyncio
+async def test_get_variables():
+    env = runner.DataFlock().environment_create("test")
+    env.cells_create([analysis.Cell("a = 1"), analysis.Cell("b = a + 1")], live=False)
+    assert await env.get_variables(["a", "b"]) == dict(a=1, b=2)
+
+
+@pytest.mark.asyncio
+async def test_versions():
+    env = runner.DataFlock().environment_create("test")
+    cid = env.cell_create(analysis.Cell("a = 1"), live=False)
+    assert env.version("a") == 0
+    await env.pull_variable("a")
+    assert env.version("a") == 1
+
+    # same value, same version
+    env.cell_update(cid, analysis.Cell("a = 2 - 1"), live=False)
+    await env.pull_variable("a")
+    assert env.version("a") == 1
+    assert await env.wait_version("a", 1, timeout=0.05) == 1
+
+    waiting = asyncio.ensure_future(env.wait_version("a", 1))
+    env.cell_update(cid, analysis.Cell("a = 2"))
+    assert await asyncio.wait_for(waiting, 5) == 2
+
+
+def test_cells_import(env):
+    cids = env.cells_import(["a = 1", "b = a"], live=False, max_workers=2)
+
+    assert env.exposes('a') == cids[0]
+    assert env.depends('a') == {cids[1]}
+    assert not any(env.is_running(c) for c in cids)
+
+
+@pytest.mark.asyncio
+async def test_cells_import_async(env):
+    cids = await env.cells_import_async(["a = 1", "b = a"], live=False)
+
+    assert env.exposes('a') == cids[0]
+    assert env.depends('a') == {cids[1]}
+
+
+def test_max_concurrency(env):
+    cid1 = env.cell_create(analysis.Cell("a = 1"), live=False)
+    cids = []
+    for i in range(3):
+        cids.append(env.cell_create(analysis.Cell("b%d = a" % i)))
+        env.on_cell_run_finished(cids[-1])
+    cid_last = env.cell_create(analysis.Cell("c = b0 + b1 + b2"))
+    env.on_cell_run_finished(cid_last)
+    env.stats['executed'] = 0
+
+    env.set_max_concurrency(2)
+    env.cell_run(cid1)
+    assert env.stats['critical_path'] == 3
+    env.on_cell_run_finished(cid1)
+
+    assert sum(env.is_running(cid) for cid in cids) == 2
+    assert env.stats['queue_depth'] == 1
+
+    running = [cid for cid in cids if env.is_running(cid)]
+    env.on_cell_run_finished(running[0])
+    assert all(env.is_running(cid) for cid in cids if cid != running[0])
+    assert env.stats['queue_depth'] == 0
+    assert not env.is_running(cid_last)
+
+    for cid in cids[:]:
+        if env.is_running(cid):
+            env.on_cell_run_finished(cid)
+    assert env.is_running(cid_last)
+    env.on_cell_run_finished(cid_last)
+
+    # every cell ran once
+    assert env.stats['executed'] == 5
+
+
+def test_rerun_while_running(env):
+    c1 = analysis.Cell("a = 1")
+    c2 = analysis.Cell("b = a + 1")
+
+    cid1 = env.cell_create(c1)
+    cid2 = env.cell_create(c2)
+    assert env.is_running(cid1)
+    assert not env.is_running(cid2)
+
+    env.cell_run(cid1)
+    env.on_cell_run_finished(cid1)
+
+    # the first run is outdated, it runs again before its dependents
+    assert env.is_running(cid1)
+    assert not env.is_running(cid2)
+
+    env.on_cell_run_finished(cid1)
+    assert env.is_running(cid2)
+
+
+@pytest.mark.asyncio
+async def test_delete_dispatched_cell():
+    env = runner.DataFlock().environment_create("test")
+    env.set_max_concurrency(1)
+    cid = env.cell_create(analysis.Cell("a = 1"))
+    assert env.is_running(cid)
+    # deleted before its run started: the only slot is free again
+    env.cell_delete(cid)
+    assert not env.is_running(cid)
+
+    env.cell_create(analysis.Cell("b = 2"))
+    assert await asyncio.wait_for(env.get_variable('b'), 5) == 2
+
+
+def test_failed_cell_keeps_dependents_dirty(env):
+    cid1 = env.cell_create(analysis.Cell("a = 1"))
+    cid2 = env.cell_create(analysis.Cell("b = a + 1"))
+
+    env.on_cell_run_failed(cid1, ZeroDivisionError())
+
+    assert not env.is_running(cid1)
+    assert env.is_dirty(cid1)
+    assert env.is_dirty(cid2)
+    assert not env.is_running(cid2)
+    assert env.stats['failed'] == 1
+
+
+@pytest.mark.asyncio
+async def test_diamond_runs_each_cell_once():
+    env = runner.DataFlock().environment_create("test")
+    calls = []
+    env.set_callback(lambda *args: calls.append(args))
+
+    cid1 = env.cell_create(analysis.Cell("a = 1"))
+    env.cell_create(analysis.Cell("b = a + 1"))
+    env.cell_create(analysis.Cell("c = a + 2"))
+    env.cell_create(analysis.Cell("d = b + c"))
+    while env._running:
+        await asyncio.sleep(0.01)
+
+    calls.clear()
+    env.cell_update(cid1, analysis.Cell("a = 2"))
+    while env._running:
+        await asyncio.sleep(0.01)
+
+    assert await env.get_variable('d') == 7
+    assert len([call for call in calls if call[0] == "running"]) == 4
+
+
+def assert_valid_order(env):
+    for cid in env.get_cells():
+        for child in env.dependent_cells(cid):
+            assert env._order[cid] < env._order[child]
+
+
+def test_self_loop(env):
+    with pytest.raises(ValueError):
+        env.cell_create(analysis.Cell("print(a)\na = 1"))
+
+    assert env.get_cells() == []
+
+
+def test_order_is_kept_when_cells_are_inserted_upstream(env):
+    # create the cells from the bottom up, so every insertion has to reorder
+    cids = [env.cell_create(analysis.Cell("v%d = v%d" % (i, i - 1))) for i in range(10, 0, -1)]
+    cids.append(env.cell_create(analysis.Cell("v0 = 1")))
+    assert_valid_order(env)
+
+    with pytest.raises(ValueError):  # loop!
+        env.cell_update(cids[-1], analysis.Cell("v0 = v5"))
+    assert_valid_order(env)
+
+    env.cell_update(cids[-1], analysis.Cell("v0 = w"))
+    env.cell_create(analysis.Cell("w = 1"))
+    assert_valid_order(env)
+
+
+def test_random_graph_order(env):
+    rng = random.Random(42)
+    for i in range(200):
+        inputs = rng.sample(range(200), 3)
+        code = "v%d = %s" % (i, " + ".join("v%d" % j for j in inputs))
+        try:
+            env.cell_create(analysis.Cell(code))
+        except ValueError:
+            pass
+        assert_valid_order(env)
+
+    # the accepted graph is a DAG, so it can be sorted
+    order, _ = env.topological_order(set(env.get_cells()))
+    assert len(order) == len(env.get_cells())
+
+
+def test_coalesce_superseded_runs(env):
+    env.set_coalesce(True)
+    cid1 = env.cell_create(analysis.Cell("a = 1"))
+    cid2 = env.cell_create(analysis.Cell("b = a + 1"))
+
+    env.cell_run(cid1)
+    env.cell_run(cid1)
+    assert env.stats['coalesced'] == 2
+    # the superseded run isn't over yet, no other run starts meanwhile
+    assert env.stats['executed'] == 1
+
+    # its results are discarded, and the cell runs once more
+    env.on_cell_run_finished(cid1, 0)
+    assert env.is_running(cid1)
+    assert env.is_dirty(cid1)
+    assert not env.is_running(cid2)
+    assert env.stats['discarded'] == 1
+    assert env.stats['executed'] == 2
+
+    env.on_cell_run_finished(cid1, 2)
+    assert env.is_running(cid2)
+
+
+@pytest.mark.asyncio
+async def test_coalesce_rapid_updates():
+    env = runner.DataFlock().environment_create("test")
+    env.set_coalesce(True)
+    calls = []
+    env.set_callback(lambda *args: calls.append(args))
+
+    cid1 = env.cell_create(analysis.Cell("a = 0"))
+    cid2 = env.cell_create(analysis.Cell("b = a + 1"))
+    for i in range(1, 6):
+        env.cell_update(cid1, analysis.Cell("a = %d" % i))
+    while env._running:
+        await asyncio.sleep(0.01)
+
+    assert await env.get_variable('b') == 6
+    assert calls.count(("finished:", cid2)) == 1
+    assert env.stats['coalesced'] == 5
+
+
+@pytest.mark.asyncio
+async def test_coalesce_subprocess_kernel():
+    flock = runner.DataFlock(kernel_factory=engine.SubprocessKernel)
+    env = flock.environment_create("test")
+    try:
+        env.set_coalesce(True)
+        cid = env.cell_create(analysis.Cell("a = 0\nfor i in range(200000):\n    a += 1"))
+        for i in range(1, 6):
+            env.cell_update(cid, analysis.Cell("a = %d\nfor i in range(200000):\n    a += 1" % i))
+        assert await asyncio.wait_for(env.get_variable('a'), 10) == 200005
+        # the first run and the latest one, the kernel didn't run the others
+        assert env.stats['executed'] == 2
+    finally:
+        flock.environemnt_delete("test")
+
+
+@pytest.mark.asyncio
+async def test_subprocess_kernel_environment():
+    flock = runner.DataFlock(kernel_factory=engine.SubprocessKernel)
+    env = flock.environment_create("test")
+    try:
+        env.cell_create(analysis.Cell("a = 1"))
+        cid2 = env.cell_create(analysis.Cell("b = a + 1"))
+        env.cell_create(analysis.Cell("c = 1 / 0"))
+        while env._running:
+            await asyncio.sleep(0.01)
+
+        assert await env.get_variable('b') == 2
+        assert not env.is_dirty(cid2)
+        assert env.stats['failed'] == 1
+    finally:
+        flock.environemnt_delete("test")
+
+
+@pytest.mark.asyncio
+async def test_kernel_died():
+    flock = runner.DataFlock(kernel_factory=engine.SubprocessKernel)
+    env = flock.environment_create("test")
+    try:
+        env.cell_create(analysis.Cell("a = 1"))
+        cid = env.cell_create(analysis.Cell("b = 2\n__import__('os')._exit(1)"))
+        await asyncio.wait_for(asyncio.sleep(0.5), 5)
+        assert not env.is_running(cid)
+        assert env.kernel.stats['deaths'] == 1
+
+        # the kernel was restarted, the cells run again when pulled
+        assert await asyncio.wait_for(env.get_variable('a'), 5) == 1
+        with pytest.raises(runner.PullFailed):
+            await asyncio.wait_for(env.get_variable('b'), 5)
+    finally:
+        flock.environemnt_delete("test")
+
+
+@pytest.mark.asyncio
+async def test_kernel_restarted_runs_live_cells():
+    flock = runner.DataFlock(kernel_factory=engine.SubprocessKernel)
+    env = flock.environment_create("test")
+    try:
+        env.cell_create(analysis.Cell("a = 1"))
+        cid2 = env.cell_create(analysis.Cell("b = a + 1"))
+        cid3 = env.cell_create(analysis.Cell("c = 1"), live=False)
+        while env._running:
+            await asyncio.sleep(0.01)
+
+        os.kill(env.kernel.rpc.process.pid, signal.SIGKILL)
+        await asyncio.sleep(0.5)
+        while env._running:
+            await asyncio.sleep(0.01)
+
+        # the live cells ran again by themselves
+        assert env.kernel.stats['deaths'] == 1
+        assert not env.is_dirty(cid2)
+        assert await env.get_variable('b', pull=False) == 2
+        assert env.is_dirty(cid3)
+    finally:
+        flock.environemnt_delete("test")
+
+
+@pytest.mark.asyncio
+async def test_cell_output():
+    env = runner.DataFlock().environment_create("test")
+    with env.output.subscribe() as output:
+        cid = env.cell_create(analysis.Cell("print('hello')"))
+        assert await asyncio.wait_for(output.get(), 5) == dict(
+            cell=cid, stream="stdout", text="hello\n")
+
+
+@pytest.mark.asyncio
+async def test_events():
+    env = runner.DataFlock().environment_create("test")
+    with env.events.subscribe() as events:
+        cid = env.cell_create(analysis.Cell("a = 1"))
+        received = []
+        while not received or received[-1]['event'] != "updated":
+            received.append(await asyncio.wait_for(events.get(), 5))
+    assert [event['event'] for event in received] == [
+        "created", "dirtied", "running", "finished", "updated"]
+    assert [event['id'] for event in received] == list(range(5))
+    assert received[-1]['args'] == ["a"]
+
+    # late subscribers get the history
+    with env.events.subscribe(replay=True) as events:
+        assert (await events.get())['args'][0] == cid
+
+
+@pytest.mark.asyncio
+async def test_interrupt_cancels_the_run():
+    flock = runner.DataFlock(kernel_factory=engine.SubprocessKernel)
+    env = flock.environment_create("test")
+    try:
+        cid1 = env.cell_create(analysis.Cell("a = 1"))
+        cid2 = env.cell_create(analysis.Cell("while True: pass\nb = a"))
+        cid3 = env.cell_create(analysis.Cell("c = b"))
+        while not env.is_running(cid2):
+            await asyncio.sleep(0.01)
+        # let the kernel start running it
+        await asyncio.sleep(0.2)
+
+        env.interrupt()
+        while env._running:
+            await asyncio.sleep(0.01)
+
+        assert not env.is_dirty(cid1)
+        assert env.is_dirty(cid2) and env.is_dirty(cid3)
+        assert env.stats['failed'] == 1
+        # the running cell, and the one waiting for it
+        assert env.stats['interrupted'] == 2
+        assert not env._ready
+
+        # the environment is still usable
+        assert await env.get_variable('a') == 1
+    finally:
+        flock.environemnt_delete("test")
+
+
+@pytest.mark.asyncio
+async def test_interrupt_drops_sent_runs():
+    flock = runner.DataFlock(kernel_factory=engine.SubprocessKernel)
+    env = flock.environment_create("test")
+    calls = []
+    env.set_callback(lambda *args: calls.append(args))
+    try:
+        # independent cells, all of them are sent to the kernel at once
+        cids = [env.cell_create(analysis.Cell("n{0} = 0\nwhile n{0} < 500000: n{0} += 1".format(i)))
+                for i in range(20)]
+        await asyncio.sleep(0.1)
+
+        env.interrupt()
+        while env._running:
+            await asyncio.sleep(0.01)
+
+        interrupted = [call[0] for call in calls].index("interrupted")
+        # the cells that didn't start are dropped too: only the one the kernel was running may
+        # finish, if the interrupt came too late for it
+        assert [call[0] for call in calls[interrupted:]].count("finished:") <= 1
+        assert len([cid for cid in cids if env.is_dirty(cid)]) > 10
+    finally:
+        flock.environemnt_delete("test")
+
+
+@pytest.mark.asyncio
+async def test_cell_timeouts():
+    env = runner.DataFlock().environment_create("test")
+    env.set_timeouts(timeout=0.1)
+    cid1 = env.cell_create(analysis.Cell("while True: pass"))
+    cid2 = env.cell_create(analysis.Cell("n = 0\nwhile n < 2000000: n += 1"), live=False)
+    env.set_cell_timeouts(cid2, timeout=1)
+    assert env.cell_timeouts(cid2) == (1, None)
+    env.cell_run(cid2)
+    while env._running:
+        await asyncio.sleep(0.01)
+
+    assert env.is_dirty(cid1)
+    assert not env.is_dirty(cid2)
+    assert env.stats['failed'] == 1
+
+
+@pytest.mark.asyncio
+async def test_environment_limits():
+    flock = runner.DataFlock(kernel_factory=engine.SubprocessKernel)
+    env = flock.environment_create("test")
+    calls = []
+    env.set_callback(lambda *args: calls.append(args))
+    try:
+        env.kernel.monitor_interval = 0.05
+        cid1 = env.cell_create(analysis.Cell("a = 1"))
+        while env._running:
+            await asyncio.sleep(0.01)
+        usage = env.usage()
+        assert usage['rss'] > 0 and usage['cells'] == 1
+
+        env.set_limits(engine.ResourceLimits(memory=usage['rss'] + 50 * 2 ** 20))
+        env.cell_create(analysis.Cell("x = b'x' * 100 * 2 ** 20\nwhile True: pass"))
+        while env._running:
+            await asyncio.sleep(0.01)
+
+        assert ("restarted", "memory") in calls
+        # the variables were gone with the old process, the live cell ran again
+        assert not env.is_dirty(cid1)
+        assert await env.get_variable('a', pull=False) == 1
+        assert env.usage()['restarts'] == 1
+    finally:
+        flock.environemnt_delete("test")
+
+
+def test_cells_pull(env):
+    cid1 = env.cell_create(analysis.Cell("a = 1"), live=False)
+    cid2 = env.cell_create(analysis.Cell("b = a + 1"), live=False)
+    cid3 = env.cell_create(analysis.Cell("c = b + 1"), live=False)
+    cid4 = env.cell_create(analysis.Cell("d = 1"), live=False)
+    assert not env._running
+    assert env.needs_pull(cid2)
+
+    assert env.cells_pull([cid2]) == {cid1, cid2}
+    assert env.is_running(cid1) and not env.is_running(cid2)
+    env.on_cell_run_finished(cid1)
+    assert env.is_running(cid2)
+    env.on_cell_run_finished(cid2)
+
+    assert not env._running
+    assert not env.needs_pull(cid2)
+    assert env.needs_pull(cid3) and env.needs_pull(cid4)
+
+    # a non-live update makes the cell stale again, and the cells that need it
+    env.cell_update(cid1, analysis.Cell("a = 2"), live=False)
+    assert env.needs_pull(cid2)
+    assert env.cells_pull([cid2]) == {cid1, cid2}
+
+
+@pytest.mark.asyncio
+async def test_pull_variable():
+    env = runner.DataFlock().environment_create("test")
+    cids = env.cells_import(["a = 1", "b = a + 1", "c = b + 1", "d = 1"], live=False,
+                            max_workers=1)
+
+    assert await env.get_variable('b') == 2
+    assert env.stats['executed'] == 2
+    assert await env.get_variable('b') == 2
+    assert env.stats['executed'] == 2
+
+    env.cell_update(cids[0], analysis.Cell("a = 10"), live=False)
+    assert await env.get_variable('c') == 12
+    assert env.stats['executed'] == 5
+    assert env.is_dirty(cids[3]) is False and env.needs_pull(cids[3])
+
+    env.cell_update(cids[0], analysis.Cell("a = 1 / 0"), live=False)
+    with pytest.raises(runner.PullFailed):
+        await env.get_variable('c')
+
+
+@pytest.mark.asyncio
+async def test_skip_unchanged():
+    env = runner.DataFlock().environment_create("test")
+    cid1 = env.cell_create(analysis.Cell("a = 1"))
+    cid2 = env.cell_create(analysis.Cell("b = a % 2"))
+    cid3 = env.cell_create(analysis.Cell("c = b + 1"))
+    while env._running:
+        await asyncio.sleep(0.01)
+
+    # same value: nothing downstream runs
+    env.cell_run(cid1)
+    while env._running:
+        await asyncio.sleep(0.01)
+    assert env.stats['executed'] == 4
+    assert env.stats['skipped'] == 2
+    assert not any(env.is_dirty(c) for c in (cid1, cid2, cid3))
+
+    # a new value that gives the same b: c is skipped
+    env.cell_update(cid1, analysis.Cell("a = 3"))
+    while env._running:
+        await asyncio.sleep(0.01)
+    assert env.stats['executed'] == 6
+    assert env.stats['skipped'] == 3
+    assert await env.get_variable('c') == 2
+
+    env.set_skip_unchanged(False)
+    env.cell_run(cid1)
+    while env._running:
+        await asyncio.sleep(0.01)
+    assert env.stats['executed'] == 9
+
+
+@pytest.mark.asyncio
+async def test_skip_unchanged_runs_stale_cells():
+    env = runner.DataFlock().environment_create("test")
+    a = env.cell_create(analysis.Cell("a = 1"))
+    b = env.cell_create(analysis.Cell("b = a + 1"), live=False)
+    await asyncio.sleep(0.05)
+
+    # b never ran, it must run even if a is unchanged
+    env.cell_run(a)
+    assert await env.get_variable('b') == 2
+
+    # same for new code that didn't run yet
+    env.cell_update(b, analysis.Cell("b = a + 2"), live=False)
+    env.cell_run(a)
+    assert await env.get_variable('b') == 3
+
+
+def test_skip_after_failure(env):
+    cid1 = env.cell_create(analysis.Cell("a = 1"))
+    cid2 = env.cell_create(analysis.Cell("b = a"))
+    env.on_cell_run_finished(cid1, info=dict(fingerprints={"a": "x"}))
+    env.on_cell_run_failed(cid2, ValueError())
+
+    # the failed cell runs again, even if its inputs are the same
+    env.cell_run(cid1)
+    env.on_cell_run_finished(cid1, info=dict(fingerprints={"a": "x"}))
+    assert env.is_running(cid2)
+
+
+@pytest.mark.asyncio
+async def test_memo():
+    env = runner.DataFlock().environment_create("test")
+    env.set_memo(10)
+    cid1 = env.cell_create(analysis.Cell("a = 1"))
+    env.cell_create(analysis.Cell("b = [a]"))
+    while env._running:
+        await asyncio.sleep(0.01)
+
+    env.cell_update(cid1, analysis.Cell("a = 2"))
+    while env._running:
+        await asyncio.sleep(0.01)
+    assert env.stats['memoized'] == 0
+
+    # back to a = 1: both cells are reused from the first run
+    env.cell_update(cid1, analysis.Cell("a = 1"))
+    while env._running:
+        await asyncio.sleep(0.01)
+    assert env.stats['memoized'] == 2
+    assert await env.get_variable('b') == [1]
@@ -1,6 +1,12 @@
 import pytest 
 from contextlib import contextmanager
+import asyncio
+import errno
+import glob
 import inspect 
+import os
+import pickle
+import time
 
 import subrpc
 
@@ -13,9 +19,67 @@ def test_command():
     assert cmd.kwargs['kw'] == 'arg'
 
 
+def test_frame():
+    data = bytearray(b"x" * 1000)
+    messages = [(0, "do_echo", (pickle.PickleBuffer(data),), {}), (1, "do_echo", ("small",), {})]
+
+    frame, buffers = subrpc.pack_frame(messages)
+    # the big buffer is not copied into the frame
+    assert len(buffers) == 1
+    assert len(frame) < len(data)
+
+    unpacked = subrpc.unpack_frame(frame, [bytes(b) for b in buffers])
+    assert bytes(unpacked[0][2][0]) == bytes(data)
+    assert unpacked[1] == (1, "do_echo", ("small",), {})
+
+    with pytest.raises(ValueError):
+        subrpc.unpack_frame(frame[:-1], buffers)
+
+
+def test_pack_frames_unpicklable():
+    errors = []
+    frames = subrpc.pack_frames([(0, True, 1), (1, True, lambda: None), (2, True, 3)],
+                                lambda message, e: errors.append(message[0]))
+    assert errors == [1]
+    assert [subrpc.unpack_frame(frame, buffers) for frame, buffers in frames] == [
+        [(0, True, 1)], [(2, True, 3)]]
+
+
+def test_shared_buffers():
+    shared = subrpc.SharedBuffers("test", threshold=100)
+    data = bytearray(b"x" * 1000)
+    frame, buffers = subrpc.pack_frame([pickle.PickleBuffer(data), b"small"], shared)
+    assert subrpc.frame_kinds(frame) == subrpc.SHARED
+    path, = buffers
+
+    mapped = subrpc.attach_shared(path)
+    assert not os.path.exists(path)
+    assert subrpc.unpack_frame(frame, [mapped]) == [mapped, b"small"]
+    assert mapped[:] == data
+
+    # files that are never received are removed with the channel
+    frame, (path,) = subrpc.pack_frame([pickle.PickleBuffer(data)], shared)
+    subrpc.remove_shared("test")
+    assert not os.path.exists(path)
+
+
+def test_shared_buffers_full(mocker):
+    mocker.patch("os.posix_fallocate", side_effect=OSError(errno.ENOSPC, "No space left"))
+    shared = subrpc.SharedBuffers("test", threshold=100)
+    data = bytearray(b"x" * 1000)
+    with pytest.raises(OSError):
+        shared.share(memoryview(data))
+
+    # the buffer goes through the pipe instead
+    frame, buffers = subrpc.pack_frame([pickle.PickleBuffer(data)], shared)
+    assert subrpc.frame_kinds(frame) == subrpc.INLINE
+    assert subrpc.unpack_frame(frame, buffers) == [data]
+    assert not glob.glob(os.path.join(subrpc.SHARED_DIR, "dataflock-test-*"))
+
+
 @contextmanager
-def rpc(slave_class):
-    rpc = subrpc.get_master_for(slave_class)
+def rpc(slave_class, framed=False, shared_threshold=None):
+    rpc = subrpc.get_master_for(slave_class, framed=framed, shared_threshold=shared_threshold)
     try:
         yield rpc
     finally:
@@ -29,6 +93,18 @@ class RpcTestSlave(subrpc.SubRPCSlave):
     async def do_raise(self):
         1 / 0
 
+    async def do_size(self, buffer):
+        return len(memoryview(buffer))
+
+    async def do_make(self, size):
+        return pickle.PickleBuffer(bytearray(b"x" * size))
+
+    async def do_exit(self):
+        os._exit(1)
+
+    async def do_block(self, seconds):
+        time.sleep(seconds)
+
 @pytest.mark.asyncio
 async def test_methods():
     with rpc(RpcTestSlave) as echo:
@@ -47,4 +123,80 @@ async def test_execution():
     with rpc(RpcTestSlave) as echo:
         with pytest.raises(subrpc.RemoteException):
             result = await echo.do_raise()
-    
\ No newline at end of file
+    
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("framed", [False, True])
+async def test_concurrent_calls(framed):
+    with rpc(RpcTestSlave, framed) as echo:
+        results = await asyncio.gather(*[echo.do_echo(i) for i in range(100)])
+        assert results == list(range(100))
+
+        with pytest.raises(subrpc.RemoteException):
+            await echo.do_raise()
+
+
+@pytest.mark.asyncio
+async def test_framed_buffers():
+    with rpc(RpcTestSlave, framed=True) as echo:
+        data = bytearray(b"x" * 100000)
+        assert await echo.do_echo(pickle.PickleBuffer(data)) == bytes(data)
+
+        # unpicklable arguments only fail their own call, even in the same frame
+        ok = asyncio.ensure_future(echo.do_echo("ok"))
+        bad = asyncio.ensure_future(echo.do_echo(lambda: None))
+        assert await asyncio.wait_for(ok, 5) == "ok"
+        with pytest.raises(Exception):
+            await asyncio.wait_for(bad, 5)
+
+
+@pytest.mark.asyncio
+async def test_reply_not_delayed():
+    with rpc(RpcTestSlave, framed=True) as echo:
+        # in the same frame, the slave answers the first and then blocks
+        fast = asyncio.ensure_future(echo.do_echo("fast"))
+        slow = asyncio.ensure_future(echo.do_block(2))
+        assert await asyncio.wait_for(fast, 1) == "fast"
+        assert not slow.done()
+        await slow
+
+
+@pytest.mark.asyncio
+async def test_shared_transfer():
+    with rpc(RpcTestSlave, framed=True, shared_threshold=1000) as echo:
+        data = bytearray(b"x" * 100000)
+        assert await echo.do_size(pickle.PickleBuffer(data)) == len(data)
+        assert await echo.do_make(100000) == data
+        # small buffers still go through the pipe
+        assert await echo.do_make(10) == b"x" * 10
+
+        tags = [shared.tag for shared in (echo.shared, echo.slave_shared)]
+    for tag in tags:
+        assert not glob.glob(os.path.join(subrpc.SHARED_DIR, "dataflock-{}-*".format(tag)))
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("framed", [False, True])
+async def test_slave_died(framed):
+    died = asyncio.Event()
+    echo = subrpc.get_master_for(RpcTestSlave, framed=framed, on_died=died.set)
+    try:
+        with pytest.raises(subrpc.RemoteDied):
+            await asyncio.wait_for(echo.do_exit(), 5)
+        await asyncio.wait_for(died.wait(), 5)
+        # later calls fail right away instead of waiting forever
+        with pytest.raises(subrpc.RemoteDied):
+            await asyncio.wait_for(echo.do_echo(1), 5)
+    finally:
+        echo.kill()
+
+
+@pytest.mark.asyncio
+async def test_broken_pipe(mocker):
+    with rpc(RpcTestSlave, framed=True) as echo:
+        mocker.patch("subrpc.send_frame", side_effect=BrokenPipeError())
+        calls = [echo.do_echo(i) for i in range(3)]
+        for call in calls:
+            with pytest.raises(subrpc.RemoteDied):
+                await asyncio.wait_for(call, 5)
+        assert not echo.pending_cmds